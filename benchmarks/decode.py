@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Decode throughput of recorded Google geocode responses
+
+Measures ``GoogleGeocodeJsonDecoder.decode`` alone, and whole lookups
+through ``GoogleGeocodes`` with an HTTP client answering from memory, which
+adds resolving the codec for every request. ``lazy/s`` decodes with
+``GoogleGeocodeLazyJsonDecoder`` and reads the first position only, as
+most callers do.
+"""
+
+import optparse
+import os
+import time
+
+import geolocation.http as http
+import geolocation.providers.google as google
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+class MemoryHttpClient(http.HttpClient):
+    """Answers every request with the same response"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def request(self, method, url, params=None, *args, **kwargs):
+        return self.data
+
+
+def rate(func, duration):
+    count = 0
+    start = time.time()
+    while True:
+        for i in xrange(100):
+            func()
+        count += 100
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-d', '--duration', type='float', default=2.0,
+                      help='seconds to run each measurement')
+    options, args = parser.parse_args()
+
+    print '%-14s %12s %12s %12s %12s' % ('response', 'decode/s', 'MB/s',
+                                         'lookup/s', 'lazy/s')
+    for name in ('address', 'reverse'):
+        with open(os.path.join(DATA, name + '.json'), 'rb') as f:
+            data = f.read()
+
+        decoder = google.GoogleGeocodeJsonDecoder('json')
+        decodes = rate(lambda: decoder.decode(data), options.duration)
+
+        lazy = google.GoogleGeocodeLazyJsonDecoder('json')
+        lazy_decodes = rate(lambda: lazy.decode(data).locations[0].position,
+                            options.duration)
+
+        geocodes = google.GoogleGeocodes(client=MemoryHttpClient(data),
+                                         coalesce=False)
+        lookups = rate(lambda: geocodes.get_by_address('x'), options.duration)
+
+        print '%-14s %12.0f %12.2f %12.0f %12.0f' % (
+            name, decodes, decodes * len(data) / 1e6, lookups, lazy_decodes)
+
+
+if __name__ == '__main__':
+    main()
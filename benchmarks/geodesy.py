@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare the scalar and batch entry points of geolocation.geodesy"""
+
+import optparse
+import random
+import time
+
+import geolocation.geodesy as geodesy
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--points', type='int', default=100000)
+    options, args = parser.parse_args()
+
+    random.seed(1)
+    n = options.points
+    lats1 = [random.uniform(-80, 80) for i in xrange(n)]
+    lngs1 = [random.uniform(-180, 180) for i in xrange(n)]
+    lats2 = [random.uniform(-80, 80) for i in xrange(n)]
+    lngs2 = [random.uniform(-180, 180) for i in xrange(n)]
+    positions = zip(lats1, lngs1, lats2, lngs2)
+
+    if geodesy.numpy is not None:
+        arrays = map(geodesy.numpy.array, (lats1, lngs1, lats2, lngs2))
+    else:
+        print 'NumPy is not installed, batch functions fall back to scalar'
+        arrays = (lats1, lngs1, lats2, lngs2)
+
+    print '%-16s %12s %12s %8s' % ('function', 'scalar/s', 'batch/s', 'speedup')
+    for name in ('haversine', 'vincenty', 'initial_bearing'):
+        scalar = getattr(geodesy, name)
+        batch = getattr(geodesy, name + '_many')
+        scalar_time = timed(lambda: [scalar(*p) for p in positions])
+        batch_time = timed(batch, *arrays)
+        print '%-16s %12.0f %12.0f %7.1fx' % (name, n / scalar_time,
+                                              n / batch_time,
+                                              scalar_time / batch_time)
+
+
+if __name__ == '__main__':
+    main()
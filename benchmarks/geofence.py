@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tagging positions with the zones containing them
+
+Creates random zones of `vertices` corners spread over Europe, and
+compares testing every zone for every position with
+``geolocation.geofence.GeofenceIndex``, one position at a time and in
+batches.
+"""
+
+import math
+import optparse
+import random
+import time
+
+import geolocation.geofence as geofence
+
+
+def zone(id, vertices):
+    lat, lng = random.uniform(35, 70), random.uniform(-10, 40)
+    radius = random.uniform(0.05, 1.0)
+    ring = []
+    for i in xrange(vertices):
+        angle = 2 * math.pi * i / vertices
+        r = radius * random.uniform(0.6, 1.0)
+        ring.append((lng + r * math.cos(angle), lat + r * math.sin(angle)))
+    return geofence.Zone(id, [[ring]])
+
+
+def rate(func, count):
+    start = time.time()
+    func()
+    return count / (time.time() - start)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-z', '--zones', type='int', default=1000,
+                      help='number of zones [%default]')
+    parser.add_option('-v', '--vertices', type='int', default=32,
+                      help='corners of every zone [%default]')
+    parser.add_option('-n', '--positions', type='int', default=20000,
+                      help='positions to tag [%default]')
+    options, args = parser.parse_args()
+
+    random.seed(1)
+    zones = [zone(i, options.vertices) for i in xrange(options.zones)]
+    lats = [random.uniform(35, 70) for i in xrange(options.positions)]
+    lngs = [random.uniform(-10, 40) for i in xrange(options.positions)]
+
+    start = time.time()
+    index = geofence.GeofenceIndex(zones)
+    print 'index built in %.1f ms, cell size %.2f degrees' % (
+        (time.time() - start) * 1000, index.cell_size)
+
+    scan_count = min(options.positions, 1000)
+    scan = rate(lambda: [[z for z in zones if z.contains(lat, lng)]
+                         for lat, lng in zip(lats[:scan_count], lngs[:scan_count])],
+                scan_count)
+    single = rate(lambda: map(index.zones_at, lats, lngs), options.positions)
+    batch = rate(lambda: index.zones_at_many(lats, lngs), options.positions)
+
+    print '%-12s %14s %10s' % ('method', 'positions/s', 'speedup')
+    for name, value in (('scan', scan), ('zones_at', single),
+                        ('zones_at_many', batch)):
+        print '%-12s %14.0f %10.1f' % (name, value, value / scan)
+
+
+if __name__ == '__main__':
+    main()
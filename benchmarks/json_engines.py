@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare JSON engines decoding recorded Google geocode responses"""
+
+import glob
+import optparse
+import os
+import time
+
+import geolocation.codecs as codecs
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def responses():
+    for path in sorted(glob.glob(os.path.join(DATA, '*.json'))):
+        with open(path, 'rb') as f:
+            yield os.path.basename(path), f.read()
+
+
+def rate(func, data, duration):
+    count = 0
+    start = time.time()
+    while True:
+        for i in xrange(100):
+            func(data)
+        count += 100
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            return count / elapsed
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-d', '--duration', type='float', default=1.0,
+                      help='seconds to run each measurement')
+    options, args = parser.parse_args()
+
+    engines = codecs.available_json_engines()
+    print 'available engines: %s' % (', '.join(engines),)
+    print '%-12s %-20s %14s %14s' % ('engine', 'response', 'str/s', 'bytearray/s')
+    for name in engines:
+        codec = codecs.GeolocationJsonCodec('json')
+        codec.engine = codecs.get_json_engine(name)
+        codec.loads = codec.engine.loads
+        for response, data in responses():
+            print '%-12s %-20s %14.0f %14.0f' % (
+                name, response,
+                rate(codec.decode, data, options.duration),
+                rate(codec.decode, bytearray(data), options.duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Scaling of decoding recorded Google geocode responses over processes
+
+Decodes the recorded responses repeated `count` times, first in this
+process alone and then with ``geolocation.parallel.ProcessDecoder`` for
+each number of processes, reading the position of the first location of
+every result. Starting the pool is not counted.
+"""
+
+import glob
+import multiprocessing
+import optparse
+import os
+import time
+
+import geolocation.parallel as parallel
+import geolocation.providers.google as google
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def payloads(count):
+    responses = []
+    for path in sorted(glob.glob(os.path.join(DATA, '*.json'))):
+        with open(path, 'rb') as f:
+            responses.append(f.read())
+    return [responses[i % len(responses)] for i in xrange(count)]
+
+
+def serial(data):
+    decoder = google.GoogleGeocodeJsonDecoder('json')
+    start = time.time()
+    for payload in data:
+        try:
+            decoder.decode(payload).locations[0].position
+        except google.geolocation.GeolocationError:
+            pass
+    return len(data) / (time.time() - start)
+
+
+def pooled(data, processes, chunksize):
+    decoder = parallel.ProcessDecoder(processes, chunksize=chunksize)
+    try:
+        start = time.time()
+        for item in decoder.decode_many(data):
+            if item.error is None:
+                item.result[0][:2]
+        return len(data) / (time.time() - start)
+    finally:
+        decoder.close()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', type='int', default=20000,
+                      help='responses to decode [%default]')
+    parser.add_option('-p', '--processes', default=None,
+                      help='comma separated numbers of processes '
+                           '(defaults to powers of two up to the CPU count)')
+    parser.add_option('-c', '--chunksize', type='int', default=64,
+                      help='responses sent to a worker at a time [%default]')
+    options, args = parser.parse_args()
+
+    if options.processes:
+        counts = [int(count) for count in options.processes.split(',')]
+    else:
+        counts = [1]
+        while counts[-1] * 2 <= multiprocessing.cpu_count():
+            counts.append(counts[-1] * 2)
+
+    data = payloads(options.count)
+    baseline = serial(data)
+    print 'cpus: %d' % (multiprocessing.cpu_count(),)
+    print '%-12s %12s %10s' % ('processes', 'decode/s', 'speedup')
+    print '%-12s %12.0f %10.2f' % ('serial', baseline, 1.0)
+    for processes in counts:
+        rate = pooled(data, processes, options.chunksize)
+        print '%-12d %12.0f %10.2f' % (processes, rate, rate / baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Local stand-in for the Google geocoding service
+
+Replays the recorded responses in ``data/``: ``reverse.json`` for requests
+by position, ``zero_results.json`` for addresses starting with ``zero``
+and ``address.json`` for other addresses. Responses can be delayed and a
+share of them replaced by errors, to benchmark without the live service.
+With compression enabled, responses are gzip compressed for clients
+accepting it.
+
+Run it on its own to point other clients at it::
+
+    python benchmarks/server.py --port 8000 --latency 0.05
+"""
+
+from __future__ import with_statement
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import gzip
+import optparse
+import os
+import random
+import threading
+import time
+import urlparse
+
+from cStringIO import StringIO
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+ERRORS = ('status', 'quota', 'reset')
+"""Injectable errors: HTTP 500, OVER_QUERY_LIMIT and closed connections"""
+
+QUOTA_BODY = '{"results": [], "status": "OVER_QUERY_LIMIT"}'
+
+
+def load_responses():
+    responses = {}
+    for name in ('address', 'reverse', 'zero_results'):
+        with open(os.path.join(DATA, name + '.json'), 'rb') as f:
+            responses[name] = f.read()
+    return responses
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        error = server.pick_error()
+        if error == 'reset':
+            self.close_connection = 1
+            return
+        if error == 'status':
+            self.reply(500, 'Internal Server Error')
+            return
+        if error == 'quota':
+            self.reply(200, QUOTA_BODY)
+            return
+
+        query = cgi.parse_qs(urlparse.urlsplit(self.path).query)
+        if 'latlng' in query:
+            name = 'reverse'
+        elif query.get('address', [''])[0].startswith('zero'):
+            name = 'zero_results'
+        else:
+            name = 'address'
+        self.reply(200, server.responses[name])
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        if self.server.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = self.server.gzipped(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server replaying recorded responses
+
+        - `addr`            -- (host, port) to listen on, port 0 picks one
+        - `latency`         -- seconds to delay every response
+        - `jitter`          -- max random seconds added to the latency
+        - `error_rate`      -- share of requests answered with an error
+        - `errors`          -- kinds of errors to inject, see `ERRORS`
+        - `compress`        -- gzip responses for clients accepting it
+
+    The number of `requests` and injected `errors` are counted in `stats`.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    # the default backlog of 5 drops connections from concurrent clients,
+    # which then wait for SYN retransmits instead of the server
+    request_queue_size = 1024
+
+    def __init__(self, addr=('127.0.0.1', 0), latency=0.0, jitter=0.0,
+                 error_rate=0.0, errors=ERRORS, compress=False):
+        BaseHTTPServer.HTTPServer.__init__(self, addr, ReplayHandler)
+        self.responses = load_responses()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.errors = errors
+        self.compress = compress
+        self.__gzipped = {}
+        self.stats = {'requests': 0, 'errors': 0}
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    @property
+    def url(self):
+        """URL template for ``GoogleGeocodesClient``"""
+        return 'http://%s:%d/maps/api/geocode/%%(format)s' % self.server_address
+
+    def count(self, name):
+        with self.__lock:
+            self.stats[name] += 1
+
+    def gzipped(self, body):
+        """Get a body gzip compressed, compressing every body once"""
+        data = self.__gzipped.get(body)
+        if data is None:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+            data = self.__gzipped[body] = buf.getvalue()
+        return data
+
+    def pick_error(self):
+        if self.error_rate and random.random() < self.error_rate:
+            self.count('errors')
+            return random.choice(self.errors)
+        return None
+
+    def start(self):
+        """Serve from a background thread, returning the server"""
+        self.__thread = threading.Thread(target=self.serve_forever)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.__thread.join()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--port', type='int', default=8000)
+    parser.add_option('-l', '--latency', type='float', default=0.0,
+                      help='seconds to delay every response')
+    parser.add_option('-j', '--jitter', type='float', default=0.0,
+                      help='max random seconds added to the latency')
+    parser.add_option('-e', '--error-rate', type='float', default=0.0,
+                      help='share of requests answered with an error')
+    parser.add_option('-z', '--compress', action='store_true', default=False,
+                      help='gzip responses for clients accepting it')
+    options, args = parser.parse_args()
+
+    server = ReplayServer(('127.0.0.1', options.port), options.latency,
+                          options.jitter, options.error_rate,
+                          compress=options.compress)
+    print 'serving %s' % (server.url,)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Cold start time of the geolocation package
+
+Every step runs in a fresh interpreter, as short-lived jobs do, timed from
+within it so that starting the interpreter itself is not counted. The best
+time over several runs is reported, together with the number of modules
+the step loads.
+"""
+
+import optparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA = os.path.join(ROOT, 'benchmarks', 'data', 'address.json')
+
+STEPS = [('import geolocation', 'import geolocation'),
+         ('create provider', 'import geolocation\n'
+                             'geolocation.GeolocationFinder("google")'),
+         ('first lookup', 'import geolocation\n'
+                          'import geolocation.http as http\n'
+                          'class Client(http.HttpClient):\n'
+                          '    def request(self, *args, **kwargs):\n'
+                          '        return open(%r, "rb").read()\n'
+                          'finder = geolocation.GeolocationFinder("google", client=Client())\n'
+                          'finder.get_by_address("Stockholm")' % (DATA,))]
+
+
+def run(code, runs):
+    """Best wall time in seconds of running code in a new interpreter"""
+    script = ('import time\n'
+              'start = time.time()\n'
+              '%s\n'
+              'print time.time() - start\n' % (code,))
+    best = None
+    for i in xrange(runs):
+        process = subprocess.Popen([sys.executable, '-c', script],
+                                   env=dict(os.environ, PYTHONPATH=ROOT),
+                                   stdout=subprocess.PIPE)
+        elapsed = float(process.communicate()[0])
+        best = best is None and elapsed or min(best, elapsed)
+    return best
+
+
+def modules(code):
+    """Number of modules loaded by code in a new interpreter"""
+    script = ('import sys\n'
+              'before = len(sys.modules)\n'
+              '%s\n'
+              'print len(sys.modules) - before\n' % (code,))
+    process = subprocess.Popen([sys.executable, '-c', script],
+                               env=dict(os.environ, PYTHONPATH=ROOT),
+                               stdout=subprocess.PIPE)
+    return int(process.communicate()[0])
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-r', '--runs', type='int', default=10,
+                      help='runs of every step, keeping the best')
+    options, args = parser.parse_args()
+
+    print '%-20s %10s %10s' % ('step', 'ms', 'modules')
+    for name, code in STEPS:
+        print '%-20s %10.1f %10d' % (name, run(code, options.runs) * 1000,
+                                     modules(code))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Throughput and latency benchmarks against a local replay server
+
+Runs lookup scenarios against ``server.ReplayServer`` and writes the
+results as JSON, for comparing runs over time::
+
+    python benchmarks/suite.py --latency 0.02 --output results.json
+    python benchmarks/suite.py --scenario batch --scenario decode
+"""
+
+from __future__ import with_statement
+
+import json
+import optparse
+import platform
+import sys
+import threading
+import time
+
+import geolocation.cache as cache
+import geolocation.codecs as codecs
+import geolocation.http as http
+import geolocation.metrics as metrics
+import geolocation.providers.google as google
+
+import server
+
+
+def summarize(latencies, elapsed, errors):
+    """Throughput and latency percentiles (in milliseconds) of a run"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    result = {'requests': count,
+              'seconds': round(elapsed, 4),
+              'requests_per_second': round(count / elapsed, 1),
+              'errors': errors}
+    for percentile in (50, 90, 99):
+        index = min(count - 1, int(count * percentile / 100.))
+        result['p%d_ms' % percentile] = count and round(latencies[index] * 1000, 3)
+    return result
+
+
+def lookup_all(geocodes, addresses):
+    latencies = []
+    errors = {}
+    start = time.time()
+    for address in addresses:
+        began = time.time()
+        try:
+            geocodes.get_by_address(address)
+        except Exception, e:
+            name = type(e).__name__
+            errors[name] = errors.get(name, 0) + 1
+        latencies.append(time.time() - began)
+    return summarize(latencies, time.time() - start, errors)
+
+
+def geocoder(replay, **kwargs):
+    """Provider using the replay server and its own connection pool"""
+    manager = http.HttpConnectionManager(**kwargs)
+    return google.GoogleGeocodes(url=replay.url, client=manager), manager
+
+
+def addresses(prefix, count):
+    return ['%s %d, Stockholm' % (prefix, i) for i in xrange(count)]
+
+
+def single(replay, options):
+    """Sequential lookups of distinct addresses"""
+    geocodes, manager = geocoder(replay)
+    try:
+        return lookup_all(geocodes, addresses('single', options.requests))
+    finally:
+        manager.close()
+
+
+def batch(replay, options):
+    """Concurrent lookups with ``get_many_by_address``"""
+    geocodes, manager = geocoder(replay)
+    errors = {}
+    start = time.time()
+    try:
+        for item in geocodes.get_many_by_address(addresses('batch', options.requests),
+                                                 concurrency=options.concurrency):
+            if item.error is not None:
+                name = type(item.error).__name__
+                errors[name] = errors.get(name, 0) + 1
+    finally:
+        manager.close()
+    elapsed = time.time() - start
+    return {'requests': options.requests,
+            'concurrency': options.concurrency,
+            'seconds': round(elapsed, 4),
+            'requests_per_second': round(options.requests / elapsed, 1),
+            'errors': errors}
+
+
+def cached(replay, options):
+    """The same addresses looked up twice through a ``MemoryCache``"""
+    manager = http.HttpConnectionManager()
+    geocodes = google.GoogleGeocodes(url=replay.url, client=manager,
+                                     cache=cache.MemoryCache())
+    lookups = addresses('cached', options.requests)
+    try:
+        cold = lookup_all(geocodes, lookups)
+        hot = lookup_all(geocodes, lookups)
+    finally:
+        manager.close()
+    return {'cold': cold, 'hot': hot, 'cache': geocodes.client.cache.stats()}
+
+
+def pool_saturation(replay, options):
+    """More threads than pooled connections
+
+    Every thread performs its share of requests through a
+    ``HttpConnectionManager`` limited to `connections` per host, measuring
+    how long requests wait for a connection.
+    """
+    geocodes, manager = geocoder(replay, max_connections=options.connections,
+                                 acquire_timeout=options.acquire_timeout)
+    sink = metrics.add_sink(metrics.MemorySink())
+    results = []
+
+    def run(index):
+        share = options.requests // options.concurrency
+        results.append(lookup_all(geocodes, addresses('pool%d' % index, share)))
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in xrange(options.concurrency)]
+    start = time.time()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        metrics.remove_sink(sink)
+        manager.close()
+    elapsed = time.time() - start
+
+    errors = {}
+    for result in results:
+        for name, count in result['errors'].iteritems():
+            errors[name] = errors.get(name, 0) + count
+
+    requests = sum(result['requests'] for result in results)
+    acquire = sink.histogram('http.acquire')
+    return {'threads': options.concurrency,
+            'connections': options.connections,
+            'requests': requests,
+            'seconds': round(elapsed, 4),
+            'requests_per_second': round(requests / elapsed, 1),
+            'acquire_p50_ms': acquire and acquire.percentile(50) * 1000,
+            'acquire_p99_ms': acquire and acquire.percentile(99) * 1000,
+            'errors': errors,
+            'pool': manager.stats()}
+
+
+def pipeline(replay, options):
+    """Lookups over one connection, one at a time and pipelined
+
+    Also counts the bytes received, compressed when the server was
+    started with ``--compress``, and after decompression.
+    """
+    results = {}
+    for name, depth in (('sequential', None), ('pipelined', options.pipeline)):
+        geocodes, manager = geocoder(replay, pipeline_depth=options.pipeline)
+        sink = metrics.add_sink(metrics.MemorySink())
+        errors = {}
+        start = time.time()
+        try:
+            lookups = addresses('pipeline_%s' % (name,), options.requests)
+            for item in geocodes.get_many_by_address(lookups, concurrency=1,
+                                                     pipeline=depth):
+                if item.error is not None:
+                    error = type(item.error).__name__
+                    errors[error] = errors.get(error, 0) + 1
+        finally:
+            metrics.remove_sink(sink)
+            manager.close()
+        elapsed = time.time() - start
+        results[name] = {'requests': options.requests,
+                         'seconds': round(elapsed, 4),
+                         'requests_per_second': round(options.requests / elapsed, 1),
+                         'received_bytes': sink.counter('http.received_bytes'),
+                         'decoded_bytes': sink.counter('http.decoded_bytes'),
+                         'errors': errors,
+                         'pool': manager.stats()}
+    results['depth'] = options.pipeline
+    return results
+
+
+def decode(replay, options):
+    """Decoding recorded responses with ``GoogleGeocodeJsonDecoder``"""
+    decoder = google.GoogleGeocodeJsonDecoder('json')
+    results = {}
+    for name in ('address', 'reverse'):
+        data = replay.responses[name]
+        count = 0
+        start = time.time()
+        while True:
+            for i in xrange(100):
+                decoder.decode(data)
+            count += 100
+            elapsed = time.time() - start
+            if elapsed >= options.duration:
+                break
+        results[name] = {'bytes': len(data),
+                         'decodes_per_second': round(count / elapsed, 1),
+                         'megabytes_per_second': round(count * len(data) / elapsed / 1e6, 2)}
+    return results
+
+
+SCENARIOS = [('single', single),
+             ('batch', batch),
+             ('cache', cached),
+             ('pool_saturation', pool_saturation),
+             ('pipeline', pipeline),
+             ('decode', decode)]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--scenario', action='append', dest='scenarios',
+                      choices=[name for name, func in SCENARIOS],
+                      help='scenario to run, may be repeated (default all)')
+    parser.add_option('-n', '--requests', type='int', default=500,
+                      help='lookups per scenario')
+    parser.add_option('-c', '--concurrency', type='int', default=16,
+                      help='concurrent lookups in batch and pool scenarios')
+    parser.add_option('--connections', type='int', default=4,
+                      help='pooled connections in the pool scenario')
+    parser.add_option('--acquire-timeout', type='float', default=5.0,
+                      help='seconds to wait for a pooled connection')
+    parser.add_option('-p', '--pipeline', type='int', default=8,
+                      help='requests sent ahead in the pipeline scenario')
+    parser.add_option('-d', '--duration', type='float', default=1.0,
+                      help='seconds to run each decode measurement')
+    parser.add_option('-l', '--latency', type='float', default=0.0,
+                      help='seconds the server delays every response')
+    parser.add_option('-j', '--jitter', type='float', default=0.0,
+                      help='max random seconds added to the latency')
+    parser.add_option('-e', '--error-rate', type='float', default=0.0,
+                      help='share of requests the server fails')
+    parser.add_option('-z', '--compress', action='store_true', default=False,
+                      help='gzip the responses of the server')
+    parser.add_option('-o', '--output', help='file to write (default stdout)')
+    options, args = parser.parse_args()
+
+    replay = server.ReplayServer(latency=options.latency, jitter=options.jitter,
+                                 error_rate=options.error_rate,
+                                 compress=options.compress).start()
+    selected = options.scenarios or [name for name, func in SCENARIOS]
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'json_engine': codecs.get_json_engine().name,
+               'time': int(time.time()),
+               'options': {'requests': options.requests,
+                           'concurrency': options.concurrency,
+                           'latency': options.latency,
+                           'jitter': options.jitter,
+                           'error_rate': options.error_rate,
+                           'compress': options.compress},
+               'scenarios': {}}
+    try:
+        for name, func in SCENARIOS:
+            if name in selected:
+                print >> sys.stderr, 'running %s' % (name,)
+                results['scenarios'][name] = func(replay, options)
+    finally:
+        replay.stop()
+    results['server'] = replay.stats
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'wb') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,127 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2009 Örjan Persson
 
+import array
+
 from geolocation import abstract
+from geolocation import orientation
 from geolocation import providers
 
 class GeolocationError(StandardError):
     pass
 
 
+class GeolocationQuotaError(GeolocationError):
+    """The provider refused the request due to exceeded quota"""
+    pass
+
+
 class GeolocationResult(abstract.Dictable):
+    __slots__ = ('locations',)
+
     def __init__(self, locations):
         self.locations = locations
 
 
+_locations = GeolocationResult.__dict__['locations']
+
+
+class LazyGeolocationResult(GeolocationResult):
+    """Geolocation result creating its locations when first read
+
+    Keeps the parsed `items` of a response, creating the `locations` from
+    them with `parse` on first access. Pickling gives a plain
+    ``GeolocationResult``.
+    """
+    __slots__ = ('_items', '_parse')
+
+    def __init__(self, items, parse):
+        self._items = items
+        self._parse = parse
+
+    @property
+    def locations(self):
+        try:
+            return _locations.__get__(self, GeolocationResult)
+        except AttributeError:
+            pass
+
+        # results are shared between threads, which may race for the first
+        # read: the items are only cleared once the locations are set
+        items = self._items
+        if items is not None:
+            locations = map(self._parse, items)
+            try:
+                return _locations.__get__(self, GeolocationResult)
+            except AttributeError:
+                _locations.__set__(self, locations)
+                self._items = None
+        return _locations.__get__(self, GeolocationResult)
+
+    def iterattrs(self):
+        yield 'locations', self.locations
+
+    def __reduce__(self):
+        return (GeolocationResult, (self.locations,))
+
+
+class ColumnarGeolocationResult(GeolocationResult):
+    """Compact geolocation result
+
+    Instead of keeping a ``Geolocation`` with positions per location, the
+    coordinates of all locations, viewports and bounds are stored in a
+    single array of floats. The `locations` are created on access, so
+    reading them works just like with ``GeolocationResult``.
+
+    Only the ``north_east`` and ``south_west`` corners of viewports and
+    bounds are kept.
+    """
+    __slots__ = ('addresses', 'coordinates')
+
+    _stride = 10
+    _corners = ('north_east', 'south_west')
+
+    def __init__(self, locations):
+        self.addresses = []
+        self.coordinates = array.array('d')
+        nan = float('nan')
+        for location in locations:
+            self.addresses.append(location.address)
+            self.coordinates.extend((location.position.lat, location.position.long))
+            for box in (location.viewport, location.bounds):
+                for corner in self._corners:
+                    if box and corner in box:
+                        self.coordinates.extend((box[corner].lat, box[corner].long))
+                    else:
+                        self.coordinates.extend((nan, nan))
+
+    def __len__(self):
+        return len(self.addresses)
+
+    @property
+    def locations(self):
+        return map(self.location, xrange(len(self)))
+
+    def location(self, index):
+        """Create the ``Geolocation`` at `index`"""
+        offset = index * self._stride
+        values = self.coordinates[offset:offset + self._stride]
+        position = orientation.GeolocationPosition(values[0], values[1])
+        viewport, bounds = [self.__box(values[i:i + 4]) for i in (2, 6)]
+        return orientation.Geolocation(self.addresses[index], position,
+                                       bounds, viewport)
+
+    def __box(self, values):
+        if values[0] != values[0]:
+            return None
+        return dict(zip(self._corners,
+                        [orientation.GeolocationPosition(values[i], values[i + 1])
+                         for i in (0, 2)]))
+
+    def __getstate__(self):
+        return {'addresses': self.addresses, 'coordinates': self.coordinates}
+
+
 def GeolocationFinder(provider='google', *args, **kwargs):
     """Create a geolocation finder
 
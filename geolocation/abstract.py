@@ -3,10 +3,35 @@
 
 
 class Dictable(object):
+    """Object represented by its attributes
+
+    Subclasses may use ``__slots__`` instead of an instance dict to save
+    memory; attributes are then looked up from the slots.
+    """
+    __slots__ = ()
+
     def __repr__(self):
-        kvs = ['%s=%s' % (k,v) for k, v in self.__dict__.iteritems()]
+        kvs = ['%s=%s' % (k,v) for k, v in self.iterattrs()]
         return '%s(%s)' % (self.__class__.__name__, ', '.join(kvs))
 
+    def iterattrs(self):
+        """Iterate over (name, value) of all set attributes"""
+        if hasattr(self, '__dict__'):
+            for item in self.__dict__.iteritems():
+                yield item
+
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name != '__dict__' and hasattr(self, name):
+                    yield name, getattr(self, name)
+
+    def __getstate__(self):
+        return dict(self.iterattrs())
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
 
 class UnknownVariant(StandardError):
     pass
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+from __future__ import with_statement
+
+import cPickle as pickle
+import math
+import os
+import threading
+import time
+
+import geolocation.metrics as metrics
+
+FOREVER = object()
+"""Time to live of entries which never expire, whatever the default ttl"""
+
+
+class CachedError(object):
+    """Negative cache entry
+
+    Wraps the error raised for a request so that it can be raised again
+    without asking the provider.
+    """
+    def __init__(self, error):
+        self.error = error
+
+
+class Cache(object):
+    """Abstract response cache
+
+    Maps request keys to decoded responses. Every entry is stored with a
+    time to live in seconds, after which it is treated as missing.
+
+        - `ttl`             -- seconds to keep responses (``None`` forever)
+        - `negative_ttl`    -- seconds to keep failed responses
+    """
+
+    def __init__(self, ttl=3600, negative_ttl=60):
+        super(Cache, self).__init__()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Get a cached value or `default` if missing or expired"""
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl=None):
+        """Store a value, using the default ttl unless given
+
+        A `ttl` of ``FOREVER`` keeps the value until it is evicted.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def items(self):
+        """Iterate over all live entries as (key, value, expires)"""
+        raise NotImplementedError()
+
+    def dump(self, fileobj):
+        """Write all live entries to a file object"""
+        pickler = pickle.Pickler(fileobj, pickle.HIGHEST_PROTOCOL)
+        for item in self.items():
+            pickler.dump(item)
+
+    def load(self, fileobj):
+        """Warm the cache with entries written by `dump`
+
+        Entries which have expired since they were dumped are skipped.
+        """
+        for key, value, ttl in self._iter_dump(fileobj):
+            self.set(key, value, ttl)
+
+    def _iter_dump(self, fileobj):
+        unpickler = pickle.Unpickler(fileobj)
+        now = time.time()
+        while True:
+            try:
+                key, value, expires = unpickler.load()
+            except EOFError:
+                break
+
+            if expires is None:
+                yield key, value, FOREVER
+            elif expires > now:
+                yield key, value, expires - now
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def expires(self, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None or ttl is FOREVER:
+            return None
+        return time.time() + ttl
+
+
+# indexes into the linked list nodes used by MemoryCache
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES = range(5)
+
+
+class MemoryCache(Cache):
+    """Bounded in-memory LRU cache
+
+    Keeps at most `size` entries. When full, the least recently used entry
+    is evicted to make room for the new one. Safe to share between threads.
+    """
+
+    def __init__(self, size=10000, *args, **kwargs):
+        if size < 1:
+            raise ValueError('A memory cache has to hold at least one entry')
+        super(MemoryCache, self).__init__(*args, **kwargs)
+        self.size = size
+        self.__lock = threading.Lock()
+        self.__clear()
+
+    def __len__(self):
+        return len(self.__map)
+
+    def get(self, key, default=None):
+        with self.__lock:
+            node = self.__map.get(key)
+            if node is None:
+                self.misses += 1
+                return default
+
+            expires = node[_EXPIRES]
+            if expires is not None and expires <= time.time():
+                self.__unlink(node)
+                del self.__map[key]
+                self.misses += 1
+                return default
+
+            # move to front, marking it as the most recently used
+            self.__unlink(node)
+            self.__link(node)
+            self.hits += 1
+            return node[_VALUE]
+
+    def set(self, key, value, ttl=None):
+        expires = self.expires(ttl)
+        with self.__lock:
+            node = self.__map.get(key)
+            if node is not None:
+                self.__unlink(node)
+            elif len(self.__map) >= self.size:
+                lru = self.__root[_PREV]
+                self.__unlink(lru)
+                del self.__map[lru[_KEY]]
+                self.evictions += 1
+
+            node = [None, None, key, value, expires]
+            self.__link(node)
+            self.__map[key] = node
+
+    def delete(self, key):
+        with self.__lock:
+            node = self.__map.pop(key, None)
+            if node is not None:
+                self.__unlink(node)
+
+    def clear(self):
+        with self.__lock:
+            self.__clear()
+
+    def items(self):
+        now = time.time()
+        with self.__lock:
+            nodes = self.__map.values()
+        for node in nodes:
+            expires = node[_EXPIRES]
+            if expires is None or expires > now:
+                yield node[_KEY], node[_VALUE], expires
+
+    def __clear(self):
+        self.__map = {}
+        self.__root = root = [None, None, None, None, None]
+        root[_PREV] = root[_NEXT] = root
+
+    def __link(self, node):
+        root = self.__root
+        first = root[_NEXT]
+        node[_PREV] = root
+        node[_NEXT] = first
+        first[_PREV] = root[_NEXT] = node
+
+    def __unlink(self, node):
+        prev, next = node[_PREV], node[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+
+
+class SqliteCache(Cache):
+    """Persistent cache stored in a sqlite database
+
+    The database is opened in write-ahead logging mode, which lets any
+    number of processes read while a single one writes. Every thread and
+    process gets its own connection, so the cache can be created before
+    forking workers.
+
+        - `path`            -- database file
+        - `size`            -- max number of entries (``None`` unbounded)
+        - `timeout`         -- seconds to wait for the write lock
+
+    Values are pickled, so anything the codecs decode to can be stored.
+    When full, the oldest entries are evicted first. Counting the entries
+    takes time in proportion to their number, so they are only counted
+    every tenth of `size` inserts, and the database may hold that many
+    entries more than `size` in between.
+    """
+
+    table = 'geolocation_cache'
+
+    def __init__(self, path, size=None, timeout=30, *args, **kwargs):
+        super(SqliteCache, self).__init__(*args, **kwargs)
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.__local = threading.local()
+        # inserts since the entries were last counted
+        self.__inserts = 0
+
+        with self.__connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS %s ('
+                         'key TEXT PRIMARY KEY, '
+                         'value BLOB NOT NULL, '
+                         'expires REAL)' % (self.table,))
+
+    def __len__(self):
+        query = 'SELECT count(*) FROM %s' % (self.table,)
+        return self.__connection().execute(query).fetchone()[0]
+
+    def get(self, key, default=None):
+        query = 'SELECT value, expires FROM %s WHERE key = ?' % (self.table,)
+        row = self.__connection().execute(query, (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return pickle.loads(str(row[0]))
+
+    def set(self, key, value, ttl=None):
+        self.__insert([(key, self.__dumps(value), self.expires(ttl))])
+
+    def delete(self, key):
+        with self.__connection() as conn:
+            conn.execute('DELETE FROM %s WHERE key = ?' % (self.table,), (key,))
+
+    def clear(self):
+        with self.__connection() as conn:
+            conn.execute('DELETE FROM %s' % (self.table,))
+
+    def purge(self):
+        """Remove all expired entries from the database"""
+        with self.__connection() as conn:
+            conn.execute('DELETE FROM %s WHERE expires <= ?' % (self.table,),
+                         (time.time(),))
+
+    def items(self):
+        query = 'SELECT key, value, expires FROM %s ' \
+                'WHERE expires IS NULL OR expires > ?' % (self.table,)
+        for key, value, expires in self.__connection().execute(query, (time.time(),)):
+            yield key, pickle.loads(str(value)), expires
+
+    def load(self, fileobj):
+        """Warm the cache with entries written by `dump`
+
+        All entries are written in a single transaction.
+        """
+        self.__insert([(key, self.__dumps(value), self.expires(ttl))
+                       for key, value, ttl in self._iter_dump(fileobj)])
+
+    def __insert(self, rows):
+        with self.__connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO %s (key, value, expires) '
+                             'VALUES (?, ?, ?)' % (self.table,), rows)
+            if self.size is not None:
+                self.__inserts += len(rows)
+                if self.__inserts < max(self.size // 10, 1):
+                    return
+                self.__inserts = 0
+                # rowids grow with every insert, the lowest ones are oldest
+                cursor = conn.execute(
+                    'DELETE FROM %(table)s WHERE rowid IN ('
+                    'SELECT rowid FROM %(table)s ORDER BY rowid LIMIT max(0, '
+                    '(SELECT count(*) FROM %(table)s) - ?))' % {'table': self.table},
+                    (self.size,))
+                self.evictions += max(cursor.rowcount, 0)
+
+    def __dumps(self, value):
+        # same as sqlite3.Binary
+        return buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def __connection(self):
+        local = self.__local
+        conn = getattr(local, 'conn', None)
+        if conn is None or local.pid != os.getpid():
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            local.conn = conn
+            local.pid = os.getpid()
+        return conn
+
+
+class ReverseCache(object):
+    """Answers reverse lookups with the results of nearby positions
+
+    Results are stored in `cache` by the geohash cell of their position,
+    with cells at least `tolerance` meters across. As cells get narrower
+    away from the equator, shorter geohashes are used at higher latitudes.
+    A lookup checks the cell of the position and its neighbors, returning
+    the result of the closest stored position within `tolerance` meters.
+    At most `per_cell` results are kept in each cell, replacing the oldest.
+
+    Lookups of a stored position are counted in `hits`, while results for
+    other positions nearby are counted in `approximate_hits` (and measured
+    as ``cache.approximate_hits`` by ``geolocation.metrics``).
+
+        - `tolerance`       -- meters between positions sharing a result
+        - `cache`           -- cache to store cells in (a ``MemoryCache``)
+        - `per_cell`        -- max results kept per cell
+    """
+
+    def __init__(self, tolerance=50.0, cache=None, per_cell=16):
+        super(ReverseCache, self).__init__()
+        self.tolerance = tolerance
+        if cache is None:
+            cache = MemoryCache()
+        self.cache = cache
+        self.per_cell = per_cell
+
+        # imported here, as geodesy loads NumPy when it is installed
+        from geolocation import geodesy, geohash
+        self.__distance = geodesy.haversine
+        self.__geohash = geohash
+        self.length = geohash.length_for(tolerance)
+        """Length of the geohashes at the equator"""
+        # degrees of latitude within the tolerance
+        self.__margin = math.degrees(tolerance / geodesy.EARTH_RADIUS)
+        self.hits = 0
+        self.approximate_hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+
+    def get(self, latitude, longitude, default=None):
+        """Get the result of the closest position within the tolerance"""
+        geohash = self.__geohash
+        cell = geohash.encode(latitude, longitude,
+                              self.__length(abs(latitude) + self.__margin))
+        best, best_distance = default, None
+        for key in [cell] + geohash.neighbors(cell):
+            for lat, lng, value in self.cache.get('geohash:' + key, ()):
+                distance = self.__distance(latitude, longitude, lat, lng)
+                if distance <= self.tolerance and (best_distance is None or
+                                                   distance < best_distance):
+                    best, best_distance = value, distance
+
+        with self.__lock:
+            if best_distance is None:
+                self.misses += 1
+            elif best_distance == 0:
+                self.hits += 1
+            else:
+                self.approximate_hits += 1
+        if best_distance:
+            metrics.increment('cache.approximate_hits')
+        return best
+
+    def set(self, latitude, longitude, value):
+        # stored at the length of every lookup within the tolerance, which
+        # is the same one unless the latitude is close to where it changes
+        margin = self.__margin
+        shortest = self.__length(abs(latitude) + 2 * margin)
+        longest = self.__length(max(abs(latitude) - margin, 0.0) + margin)
+        with self.__lock:
+            for length in xrange(shortest, longest + 1):
+                key = 'geohash:' + self.__geohash.encode(latitude, longitude,
+                                                         length)
+                entries = [entry for entry in self.cache.get(key, ())
+                           if entry[:2] != (latitude, longitude)]
+                entries.append((latitude, longitude, value))
+                self.cache.set(key, tuple(entries[-self.per_cell:]))
+
+    def __length(self, latitude):
+        """Length of the cells at least `tolerance` wide up to `latitude`"""
+        return self.__geohash.length_for(self.tolerance, latitude)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'approximate_hits': self.approximate_hits,
+                'misses': self.misses}
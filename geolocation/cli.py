@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+"""Bulk geocoding of CSV and JSON lines files
+
+Records are streamed through reading, geocoding (removing duplicates on
+the way) and writing, holding only a bounded number of them in memory.
+Progress is checkpointed, so a run which is stopped can be resumed where
+it left off by running the same command again::
+
+    python -m geolocation.cli --address-column address places.csv out.csv
+    python -m geolocation.cli --lat-column lat --lng-column lng \\
+        --rate 10 fixes.jsonl out.jsonl
+
+Every output record is the input record with the columns ``latitude``,
+``longitude``, ``formatted_address`` and ``geocode_error`` added.
+"""
+
+from __future__ import with_statement
+
+import csv
+import inspect
+import json
+import optparse
+import os
+import sys
+import time
+
+import geolocation
+
+from geolocation import abstract
+from geolocation import concurrency
+from geolocation import normalize
+from geolocation import providers
+
+COLUMNS = ['latitude', 'longitude', 'formatted_address', 'geocode_error']
+"""Columns added to every record"""
+
+EXIT_TEMPFAIL = 75
+"""Exit status when the provider quota ran out, to resume later"""
+
+
+class _CountingFile(object):
+    """Iterates over the lines of a file, counting the bytes read"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.position = 0
+
+    def __iter__(self):
+        for line in self.fileobj:
+            self.position += len(line)
+            yield line
+
+
+class RecordReader(object):
+    """Reads the records of a file as dicts
+
+    The `fieldnames` are the columns of a CSV file in order, and ``None``
+    for JSON lines.
+    """
+
+    def __init__(self, fileobj, format):
+        self.fileobj = fileobj
+        self.format = format
+        self.fieldnames = None
+        if format == 'csv':
+            self.__csv = csv.DictReader(fileobj)
+            self.fieldnames = self.__csv.fieldnames
+
+    def __iter__(self):
+        if self.format == 'csv':
+            for record in self.__csv:
+                yield record
+        else:
+            for line in self.fileobj:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class RecordWriter(object):
+    """Writes records in the format of the input, with `COLUMNS` added
+
+    CSV columns are written in the order of `fieldnames`, the columns of
+    the input, followed by the `COLUMNS` not among them.
+    """
+
+    def __init__(self, fileobj, format, fieldnames=None):
+        self.fileobj = fileobj
+        self.format = format
+        self.fieldnames = fieldnames
+        self.__csv = None
+
+    def write(self, record):
+        if self.format != 'csv':
+            self.fileobj.write(json.dumps(record) + '\n')
+            return
+
+        if self.__csv is None:
+            fields = self.fieldnames
+            if fields is None:
+                fields = [f for f in record.keys() if f not in COLUMNS]
+            fields = list(fields) + [c for c in COLUMNS if c not in fields]
+            self.__csv = csv.DictWriter(self.fileobj, fields)
+            if self.fileobj.tell() == 0:
+                self.__csv.writeheader()
+        self.__csv.writerow(dict((k, _utf8(v)) for k, v in record.iteritems()))
+
+
+class Checkpoint(object):
+    """Progress of a run, saved as JSON next to the output
+
+    Holds the number of input records done and the size of the output
+    after writing them, so that a resumed run can skip the records and
+    drop anything written after the checkpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self.output_size = 0
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                state = json.load(f)
+            self.records = state['records']
+            self.output_size = state['output_size']
+        return self
+
+    def save(self, records, output):
+        output.flush()
+        os.fsync(output.fileno())
+        self.records = records
+        self.output_size = output.tell()
+
+        # replaced atomically, so a crash leaves either checkpoint
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as f:
+            json.dump({'records': self.records,
+                       'output_size': self.output_size}, f)
+        os.rename(temp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Progress(object):
+    """Reports records per second and the estimated time left
+
+    The time left is estimated from how fast the input file is read.
+    """
+
+    def __init__(self, total_bytes, interval=10.0, stream=sys.stderr):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.stream = stream
+        self.start = None
+
+    def update(self, records, position, force=False):
+        """Report progress at most every `interval` seconds
+
+            - `records`     -- records done in total
+            - `position`    -- bytes of the input read
+        """
+        now = time.time()
+        if self.start is None:
+            self.start = self.last = now
+            self.start_records, self.start_position = records, position
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+
+        elapsed = max(now - self.start, 1e-6)
+        line = '%d records, %.1f records/s' % (
+            records, (records - self.start_records) / elapsed)
+        if self.total_bytes:
+            line += ', %.1f%%' % (100. * position / self.total_bytes,)
+            speed = (position - self.start_position) / elapsed
+            if speed > 0 and position < self.total_bytes:
+                left = int((self.total_bytes - position) / speed)
+                line += ', ETA %d:%02d:%02d' % (left // 3600, left // 60 % 60,
+                                                left % 60)
+        print >> self.stream, line
+
+
+class Pipeline(object):
+    """Geocodes a stream of records
+
+    Looks up the address in `address_column`, or the position in
+    `lat_column` and `lng_column`. Addresses are compared in their
+    normalized form (see ``geolocation.normalize``) when removing
+    duplicates, of which the latest `remember` results are kept.
+
+        - `finder`          -- provider to look up records with
+        - `concurrency`     -- simultaneous lookups
+        - `buffer`          -- max records read but not yet written
+    """
+
+    def __init__(self, finder, address_column=None, lat_column=None,
+                 lng_column=None, concurrency=8, buffer=None, remember=10000):
+        if not address_column and not (lat_column and lng_column):
+            raise ValueError('Either an address column or latitude and '
+                             'longitude columns have to be given')
+        self.finder = finder
+        self.address_column = address_column
+        self.lat_column = lat_column
+        self.lng_column = lng_column
+        self.concurrency = concurrency
+        self.buffer = buffer
+        self.remember = remember
+
+    def run(self, records):
+        """Yield every record with the lookup columns added
+
+        Raises ``geolocation.GeolocationQuotaError`` at the first record
+        refused due to the quota, as every following one would be too.
+        """
+        results = concurrency.batch_map(self.lookup, records, self.concurrency,
+                                        key=self.key, buffer=self.buffer,
+                                        remember=self.remember)
+        try:
+            for item in results:
+                if isinstance(item.error, geolocation.GeolocationQuotaError):
+                    raise item.error
+                yield self.annotate(item.item, item.result, item.error)
+        finally:
+            # stops the lookups still running when leaving early
+            results.close()
+
+    def key(self, record):
+        if self.address_column:
+            return normalize.normalize_address(record.get(self.address_column) or '')
+        return (record.get(self.lat_column), record.get(self.lng_column))
+
+    def lookup(self, record):
+        if self.address_column:
+            return self.finder.get_by_address(_utf8(record.get(self.address_column) or ''))
+        return self.finder.get_by_position(float(record[self.lat_column]),
+                                           float(record[self.lng_column]))
+
+    def annotate(self, record, result, error):
+        record = dict(record, **dict.fromkeys(COLUMNS, ''))
+        if error is not None:
+            record['geocode_error'] = str(error) or type(error).__name__
+        elif result is not None and result.locations:
+            # fields may be left out by the provider
+            location = result.locations[0]
+            if location.position is not None:
+                record['latitude'] = location.position.lat
+                record['longitude'] = location.position.long
+            if location.address is not None:
+                record['formatted_address'] = ', '.join(
+                    part.long for part in location.address.parts).decode('utf-8')
+        return record
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _accepts(provider, name):
+    """Check if a provider is created with a keyword argument `name`"""
+    if inspect.isclass(provider):
+        provider = provider.__init__
+    try:
+        spec = inspect.getargspec(provider)
+    except TypeError:
+        return False
+    return name in spec.args or spec.keywords is not None
+
+
+def _skip(records, count):
+    for index, record in enumerate(records):
+        if index >= count:
+            yield record
+
+
+def geocode_file(pipeline, input_path, output_path, format=None,
+                 checkpoint_every=1000, progress_interval=10.0):
+    """Geocode a file, resuming from its checkpoint if there is one
+
+    Returns the number of records done.
+    """
+    if format is None:
+        format = input_path.endswith('.csv') and 'csv' or 'jsonl'
+
+    checkpoint = Checkpoint(output_path + '.checkpoint').load()
+    progress = Progress(os.path.getsize(input_path), progress_interval)
+
+    with open(input_path, 'rb') as source:
+        with open(output_path, checkpoint.records and 'r+b' or 'wb') as output:
+            # drop anything written after the last checkpoint
+            output.truncate(checkpoint.output_size)
+            output.seek(checkpoint.output_size)
+
+            lines = _CountingFile(source)
+            reader = RecordReader(lines, format)
+            records = _skip(reader, checkpoint.records)
+            writer = RecordWriter(output, format, reader.fieldnames)
+            done = checkpoint.records
+            try:
+                for record in pipeline.run(records):
+                    writer.write(record)
+                    done += 1
+                    if done % checkpoint_every == 0:
+                        checkpoint.save(done, output)
+                    progress.update(done, lines.position)
+            finally:
+                checkpoint.save(done, output)
+                progress.update(done, lines.position, force=True)
+
+    checkpoint.remove()
+    return done
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options] INPUT OUTPUT')
+    parser.add_option('-a', '--address-column',
+                      help='column holding the address to look up')
+    parser.add_option('--lat-column', help='column holding the latitude')
+    parser.add_option('--lng-column', help='column holding the longitude')
+    parser.add_option('-f', '--format', choices=['csv', 'jsonl'],
+                      help='input format (default from the file extension)')
+    parser.add_option('-p', '--provider', default='google',
+                      help='geolocation provider [%default]')
+    parser.add_option('-c', '--concurrency', type='int', default=8,
+                      help='simultaneous lookups [%default]')
+    parser.add_option('-r', '--rate', type='float',
+                      help='max lookups per second, adapting to the quota')
+    parser.add_option('--cache', help='SQLite file caching lookups between runs')
+    parser.add_option('--checkpoint-every', type='int', default=1000,
+                      help='records between checkpoints [%default]')
+    parser.add_option('--progress', type='float', default=10.0,
+                      help='seconds between progress reports [%default]')
+    options, args = parser.parse_args(args)
+
+    if len(args) != 2:
+        parser.error('INPUT and OUTPUT have to be given')
+    if not options.address_column and not (options.lat_column and
+                                           options.lng_column):
+        parser.error('--address-column or --lat-column and --lng-column '
+                     'have to be given')
+
+    manager = providers.GeolocationProviderManager
+    try:
+        provider = manager.get_class(options.provider)
+    except abstract.UnknownVariant:
+        parser.error('unknown provider %s (available: %s)' % \
+                     (options.provider, ', '.join(manager.creatables())))
+    for option, name in (('cache', 'cache'), ('rate', 'rate_limiter')):
+        if getattr(options, option) and not _accepts(provider, name):
+            parser.error('--%s is not supported by the %s provider' % \
+                         (option, options.provider))
+
+    kwargs = {}
+    if options.cache:
+        from geolocation import cache
+        kwargs['cache'] = cache.SqliteCache(options.cache)
+    if options.rate:
+        from geolocation import ratelimit
+        kwargs['rate_limiter'] = ratelimit.AdaptiveRateLimiter(options.rate)
+
+    finder = geolocation.GeolocationFinder(options.provider, **kwargs)
+    pipeline = Pipeline(finder, options.address_column, options.lat_column,
+                        options.lng_column, options.concurrency)
+    try:
+        geocode_file(pipeline, args[0], args[1], options.format,
+                     options.checkpoint_every, options.progress)
+    except geolocation.GeolocationQuotaError, e:
+        print >> sys.stderr, '%s, run again to resume' % (e,)
+        return EXIT_TEMPFAIL
+    except KeyboardInterrupt:
+        print >> sys.stderr, 'Interrupted, run again to resume'
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
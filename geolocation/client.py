@@ -4,25 +4,78 @@
 from __future__ import with_statement
 
 import logging
+import threading
+import time
+import urlparse
 
+import geolocation
+import geolocation.cache as cache
 import geolocation.codecs as codecs
-import geolocation.http as http
+import geolocation.concurrency as concurrency
+import geolocation.metrics as metrics
 
 log = logging.getLogger(__name__)
 
+_missing = object()
+
+
+def _connection_manager(**kwargs):
+    # httplib and ssl are only imported once a connection is needed
+    import geolocation.http as http
+    return http.HttpConnectionManager(**kwargs)
+
 
 class GeolocationHttpClient(object):
     """Geolocation Http Client
 
-    Keeps a pool of http connections and codecs.
+    Keeps a pool of http connections and codecs. The `decoders` are codec
+    classes, or a dict of variant to codec class, with the registered
+    ``geolocation.codecs.GeolocationCodecs`` used if not given. Each
+    variant is instantiated once per client, when first used.
+
+    If a `cache` (see ``geolocation.cache.Cache``) is given, decoded
+    responses are kept in it keyed on the request. Requests failing with a
+    ``GeolocationError`` are cached as well, using the negative ttl of the
+    cache.
+
+    If a `rate_limiter` (see ``geolocation.ratelimit``) is given, every
+    request waits for it before being sent. Requests refused by the provider
+    due to its quota are retried up to `retries` times, waiting as long as
+    the rate limiter tells.
+
+    Unless `coalesce` is false, identical requests made at the same time by
+    several threads are sent once, all of them getting the same result. The
+    number of saved requests is counted by `single_flight.coalesced`.
+
+    Requests are timed as ``provider.request`` by ``geolocation.metrics``,
+    labeled with `provider_name`.
     """
+    provider_name = 'http'
+    """Name of the provider in measurements"""
 
-    def __init__(self, client=None, decoders=None):
+    def __init__(self, client=None, decoders=None, cache=None,
+                 rate_limiter=None, retries=3, coalesce=True):
         super(GeolocationHttpClient, self).__init__()
-        self.__client = client or http.HttpConnectionManager()
-        self.__decoders = codecs.setup(decoders or codecs.GeolocationCodecs)
+        self.__client = client
+        self.__client_lock = threading.Lock()
+        self.__decoder_classes = decoders
+        self.__decoders = {}
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.single_flight = coalesce and concurrency.SingleFlight() or None
 
-    def request(self, method, url, params, codec=None):
+    @property
+    def http_client(self):
+        """The HTTP client, a ``geolocation.http.HttpConnectionManager``
+        created on first use unless one was given"""
+        if self.__client is None:
+            with self.__client_lock:
+                if self.__client is None:
+                    self.__client = _connection_manager()
+        return self.__client
+
+    def request(self, method, url, params, codec=None, key_params=None):
         """Retrieve and decode data via HTTP
 
         Arguments:
@@ -30,10 +83,254 @@ class GeolocationHttpClient(object):
             - `url`         -- HTTP url
             - `params`      -- HTTP parameters as a dict
             - `codec`       -- data decoder (optional)
+            - `key_params`  -- parameters identifying the request in the
+                               cache and when coalescing, if not `params`
+        """
+        with metrics.timed('provider.request', provider=self.provider_name):
+            return self.__cached_request(method, url, params, codec, key_params)
+
+    def __cached_request(self, method, url, params, codec, key_params):
+        if self.cache is None and self.single_flight is None:
+            return self.__request(method, url, params, codec)
+
+        key = self.cache_key(method, url, key_params or params, codec)
+        if self.cache is not None:
+            data = self.cache.get(key, _missing)
+            if data is not _missing:
+                if isinstance(data, cache.CachedError):
+                    raise data.error
+                return data
+
+        if self.single_flight is None:
+            return self.__load(key, method, url, params, codec)
+        return self.single_flight.do(key, self.__load,
+                                     key, method, url, params, codec)
+
+    def __load(self, key, method, url, params, codec):
+        if self.cache is None:
+            return self.__request(method, url, params, codec)
+
+        try:
+            data = self.__request(method, url, params, codec)
+        except geolocation.GeolocationQuotaError:
+            raise
+        except geolocation.GeolocationError, e:
+            self.cache.set(key, cache.CachedError(e), self.cache.negative_ttl)
+            raise
+
+        self.cache.set(key, data)
+        return data
+
+    def request_many(self, method, url, params_list, codec=None,
+                     key_params_list=None):
+        """Retrieve and decode several requests, pipelining them
+
+        Works like `request` for every dict of parameters in `params_list`,
+        but those not in the cache are sent at once with ``request_many``
+        of the HTTP client, which pipelines them over one connection.
+        Identical requests in the list are only sent once. Unlike with
+        `request`, the requests are not coalesced with those of other
+        threads, nor retried when refused due to the quota.
+
+        Returns a ``geolocation.concurrency.BatchResult`` for each request,
+        with its parameters as the item, in the order of `params_list`.
+        """
+        results = [None] * len(params_list)
+        pending = {}
+        for index, params in enumerate(params_list):
+            key_params = key_params_list and key_params_list[index] or params
+            key = self.cache_key(method, url, key_params, codec)
+            if key in pending:
+                pending[key][1].append(index)
+                continue
+
+            data = _missing
+            if self.cache is not None:
+                data = self.cache.get(key, _missing)
+            if data is _missing:
+                pending[key] = (params, [index])
+            elif isinstance(data, cache.CachedError):
+                results[index] = concurrency.BatchResult(index, params,
+                                                         error=data.error)
+            else:
+                results[index] = concurrency.BatchResult(index, params, data)
+
+        if self.rate_limiter is not None:
+            for i in xrange(len(pending)):
+                self.rate_limiter.acquire()
+
+        keys = pending.keys()
+        responses = self.http_client.request_many(
+            method, [(url, pending[key][0]) for key in keys])
+        decoder = self.__decoder(codec)
+        for key, response in zip(keys, responses):
+            if response.error is not None:
+                outcome = (None, response.error)
+            else:
+                outcome = self.__decode_many(key, decoder, response.result)
+            for index in pending[key][1]:
+                results[index] = concurrency.BatchResult(
+                    index, params_list[index], *outcome)
+        return results
+
+    def __decode_many(self, key, decoder, data):
+        """Decode and cache a response of `request_many` as (data, error)"""
+        try:
+            if decoder is not None:
+                data = decoder.decode(data)
+        except geolocation.GeolocationQuotaError, e:
+            return None, e
+        except geolocation.GeolocationError, e:
+            if self.cache is not None:
+                self.cache.set(key, cache.CachedError(e), self.cache.negative_ttl)
+            return None, e
+        except Exception, e:
+            return None, e
+
+        if self.cache is not None:
+            self.cache.set(key, data)
+        return data, None
+
+    def stream(self, method, url, params, codec=None, max_size=1 << 20):
+        """Retrieve and decode data via HTTP incrementally
+
+        Yields the items decoded by the `codec` while the response is being
+        read, which requires a codec with an `iter_decode` method. Streamed
+        requests bypass the cache.
+
+        Arguments:
+            - `max_size`    -- max bytes of a single item in the response
+
+        For the other arguments, see `request`.
         """
-        data = self.__client.request(method, url, params)
-        if self.__decoders.supports(codec):
-            codec = self.__decoders.get(codec)
-            data = codec.decode(data)
+        codec = self.__decoder(codec)
+        if not hasattr(codec, 'iter_decode'):
+            raise codecs.CodecError('%r does not support streaming' % (codec,))
+
+        chunks = self.http_client.stream(method, url, params)
+        try:
+            for item in codec.iter_decode(chunks, max_size):
+                yield item
+        finally:
+            chunks.close()
+
+    def cache_key(self, method, url, params, codec=None):
+        """Create a key identifying the request
+
+        Parameters are encoded in sorted order, so the same request always
+        gets the same key regardless of argument order.
+        """
+        variant = getattr(codec, 'variant', codec)
+        return '%s %s?%s %s' % (method, url,
+                                self.http_client.encode_params(params), variant)
+
+    def __request(self, method, url, params, codec):
+        limiter = self.rate_limiter
+        if limiter is None:
+            return self.__fetch(method, url, params, codec)
+
+        for attempt in xrange(self.retries + 1):
+            limiter.acquire()
+            try:
+                data = self.__fetch(method, url, params, codec)
+            except geolocation.GeolocationQuotaError:
+                delay = limiter.throttled(attempt)
+                if attempt == self.retries:
+                    raise
+                log.info('Over query limit, retrying in %.2f seconds', delay)
+                time.sleep(delay)
+            else:
+                limiter.succeeded()
+                return data
+
+    def __fetch(self, method, url, params, codec):
+        data = self.http_client.request(method, url, params)
+        decoder = self.__decoder(codec)
+        if decoder is not None:
+            data = decoder.decode(data)
 
         return data
+
+    def __decoder(self, codec):
+        """Resolve a codec variant to its decoder, once per client
+
+        Returns ``None`` for variants without a decoder, whose responses
+        are returned as they are. Codec instances are used as given.
+        """
+        try:
+            return self.__decoders[codec]
+        except KeyError:
+            pass
+
+        decoder = codec
+        if isinstance(codec, basestring):
+            decoder = self.__create_decoder(codec)
+        self.__decoders[codec] = decoder
+        return decoder
+
+    def __create_decoder(self, variant):
+        decoders = self.__decoder_classes
+        if decoders is None:
+            if not codecs.GeolocationCodecs.supports(variant):
+                return None
+            return codecs.GeolocationCodecs.create(variant)
+
+        if isinstance(decoders, dict):
+            decoder = decoders.get(variant)
+        else:
+            # like registering them in order, the last one wins
+            matching = [d for d in decoders if variant in d.formats]
+            decoder = matching and matching[-1] or None
+        return decoder and decoder(variant)
+
+
+class AsyncGeolocationHttpClient(GeolocationHttpClient):
+    """Asynchronous Geolocation Http Client
+
+    Works like ``GeolocationHttpClient`` but `request` returns at once with
+    a ``geolocation.concurrency.Future``. Requests are performed by a pool
+    of worker threads, using the same connection pool and codecs as the
+    synchronous client, so both return identical results.
+
+        - `workers`         -- number of requests performed at once
+        - `per_host`        -- max number of simultaneous requests per host
+        - `timeout`         -- socket timeout in seconds
+        - `pool`            -- ``WorkerPool`` to use instead of a new one
+    """
+
+    def __init__(self, client=None, workers=8, per_host=4, timeout=None,
+                 pool=None, *args, **kwargs):
+        client = client or _connection_manager(timeout=timeout)
+        super(AsyncGeolocationHttpClient, self).__init__(client, *args, **kwargs)
+        self.pool = pool or concurrency.WorkerPool(workers)
+        self.per_host = per_host
+        self.__hosts = {}
+        self.__hosts_lock = threading.Lock()
+
+    def request(self, method, url, params, codec=None, key_params=None):
+        """Retrieve and decode data via HTTP in the background
+
+        Takes the same arguments as ``GeolocationHttpClient.request`` and
+        returns a ``Future`` for the decoded data.
+        """
+        request = super(AsyncGeolocationHttpClient, self).request
+        semaphore = self.__host_semaphore(url)
+
+        def call():
+            with semaphore:
+                return request(method, url, params, codec, key_params)
+
+        return self.pool.submit(call)
+
+    def close(self):
+        """Stop the worker threads, cancelling requests not yet started"""
+        self.pool.shutdown()
+
+    def __host_semaphore(self, url):
+        host = urlparse.urlsplit(url).netloc
+        with self.__hosts_lock:
+            semaphore = self.__hosts.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host)
+                self.__hosts[host] = semaphore
+            return semaphore
@@ -2,13 +2,12 @@
 # Copyright (C) 2009 Örjan Persson
 
 import copy
-try:
-    import json
-except ImportError:
-    import simplejson as json
+import struct
 
 import geolocation
 import geolocation.abstract as abstract
+import geolocation.metrics as metrics
+import geolocation.orientation as orientation
 
 
 class CodecError(StandardError):
@@ -87,14 +86,316 @@ class GeolocationCodecs(CodecFactory):
     """
     pass
 
+class JsonEngine(object):
+    """JSON implementation used by the JSON codecs
+
+        - `name`            -- name of the engine
+        - `loads`           -- function parsing a JSON document
+        - `dumps`           -- function serializing to a JSON string
+        - `buffers`         -- if `loads` accepts buffers such as bytearray
+                               and memoryview without copying them
+    """
+    def __init__(self, name, loads, dumps, buffers=False):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        self.buffers = buffers
+
+    def __repr__(self):
+        return 'JsonEngine(%s)' % (self.name,)
+
+
+def _orjson():
+    import orjson
+    return JsonEngine('orjson', orjson.loads,
+                      lambda data: orjson.dumps(data).decode('utf-8'),
+                      buffers=True)
+
+
+def _ujson():
+    import ujson
+    return JsonEngine('ujson', ujson.loads, ujson.dumps)
+
+
+def _simplejson():
+    import simplejson
+    return JsonEngine('simplejson', simplejson.loads, simplejson.dumps)
+
+
+def _json():
+    import json
+    return JsonEngine('json', json.loads, json.dumps)
+
+
+json_engines = [('orjson', _orjson),
+                ('ujson', _ujson),
+                ('simplejson', _simplejson),
+                ('json', _json)]
+"""Known JSON engines in order of preference, as (name, factory)"""
+
+_json_engines = {}
+
+
+def register_json_engine(name, factory, preferred=True):
+    """Add a JSON engine
+
+    The `factory` is called without arguments the first time the engine is
+    used, returning a ``JsonEngine``, or raising ``ImportError`` if the
+    engine is not installed. Preferred engines are tried before all others.
+    """
+    unregister = [e for e in json_engines if e[0] == name]
+    for engine in unregister:
+        json_engines.remove(engine)
+    _json_engines.pop(name, None)
+
+    if preferred:
+        json_engines.insert(0, (name, factory))
+    else:
+        json_engines.append((name, factory))
+
+
+def get_json_engine(name=None):
+    """Get a JSON engine by name, or the most preferred one installed"""
+    for engine_name, factory in json_engines:
+        if name is not None and engine_name != name:
+            continue
+
+        engine = _json_engines.get(engine_name)
+        if engine is None:
+            try:
+                engine = _json_engines[engine_name] = factory()
+            except ImportError:
+                continue
+        return engine
+
+    raise UnknownCodec('No JSON engine %s available (tried: %s)' % \
+                       (name or '', ', '.join([e[0] for e in json_engines])))
+
+
+def available_json_engines():
+    """Names of all installed JSON engines, in order of preference"""
+    names = []
+    for name, factory in json_engines:
+        try:
+            get_json_engine(name)
+        except UnknownCodec:
+            continue
+        names.append(name)
+    return names
+
+
 class GeolocationJsonCodec(GeolocationCodec):
+    """JSON codec
+
+    Uses the most preferred JSON engine installed, unless `json_engine` is
+    set to the name of another one.
+
+    Data to decode can be given as a string or as a buffer (bytearray,
+    buffer or memoryview) such as a response read straight from a socket.
+    Engines supporting buffers parse them in place; others get a single
+    copy as a string.
+    """
     formats = ['json']
 
+    json_engine = None
+    """Name of the JSON engine to use (``None`` for the preferred one)"""
+
+    def __init__(self, *args, **kwargs):
+        super(GeolocationJsonCodec, self).__init__(*args, **kwargs)
+        self.engine = get_json_engine(self.json_engine)
+        self.loads = self.engine.loads
+
+    def decode(self, data):
+        if not isinstance(data, basestring) and not self.engine.buffers:
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            else:
+                data = str(data)
+        with metrics.timed('decode.json'):
+            return self.loads(data)
+
+    def encode(self, data):
+        return self.engine.dumps(data)
+
+
+_BINARY_MAGIC = 'GLB1'
+_BINARY_HEADER = struct.Struct('<4sIII')
+_BINARY_OFFSET = struct.Struct('<I')
+_BINARY_LOCATION = struct.Struct('<2dBH')
+_BINARY_BOX = struct.Struct('<4d')
+_BINARY_PART = struct.Struct('<3I')
+_BINARY_CORNERS = ('north_east', 'south_west')
+
+
+class BinaryGeolocationResult(geolocation.GeolocationResult):
+    """Geolocation result decoded lazily from binary data
+
+    Nothing but the header is read up front; each location is decoded on
+    first access, so reading ``locations[0].position`` only decodes the
+    first location.
+    """
+    __slots__ = ('data', '_cache', '_strings', '_header')
+
+    def __init__(self, data):
+        magic, count, strings, strings_offset = _BINARY_HEADER.unpack_from(data, 0)
+        if magic != _BINARY_MAGIC:
+            raise GeolocationDecodeError('Not binary geolocation data')
+
+        self.data = data
+        self._header = (count, strings, strings_offset)
+        self._cache = {}
+        self._strings = {}
+
+    def __len__(self):
+        return self._header[0]
+
+    @property
+    def locations(self):
+        return _LazyLocations(self)
+
+    def location(self, index):
+        """Decode the ``Geolocation`` at `index`"""
+        location = self._cache.get(index)
+        if location is None:
+            location = self._cache[index] = self.__decode(index)
+        return location
+
+    def string(self, sid):
+        value = self._strings.get(sid)
+        if value is None:
+            offset = self._header[2] + sid * _BINARY_OFFSET.size
+            start, end = struct.unpack_from('<2I', self.data, offset)
+            base = self._header[2] + (self._header[1] + 1) * _BINARY_OFFSET.size
+            value = self._strings[sid] = intern(str(self.data[base + start:base + end]))
+        return value
+
+    def __decode(self, index):
+        offset = _BINARY_OFFSET.unpack_from(self.data, _BINARY_HEADER.size +
+                                            index * _BINARY_OFFSET.size)[0]
+        lat, lng, flags, parts = _BINARY_LOCATION.unpack_from(self.data, offset)
+        offset += _BINARY_LOCATION.size
+
+        boxes = []
+        for flag in (1, 2):
+            box = None
+            if flags & flag:
+                values = _BINARY_BOX.unpack_from(self.data, offset)
+                offset += _BINARY_BOX.size
+                box = {'north_east': orientation.GeolocationPosition(*values[:2]),
+                       'south_west': orientation.GeolocationPosition(*values[2:])}
+            boxes.append(box)
+
+        address = []
+        for i in xrange(parts):
+            short, long, types = _BINARY_PART.unpack_from(self.data, offset)
+            offset += _BINARY_PART.size
+            types = self.string(types)
+            address.append(orientation.GeolocationAddressPart(
+                self.string(short), self.string(long),
+                frozenset(types and types.split(',') or ())))
+
+        return orientation.Geolocation(orientation.GeolocationAddress(address),
+                                       orientation.GeolocationPosition(lat, lng),
+                                       boxes[1], boxes[0])
+
+    def __getstate__(self):
+        return {'data': str(self.data)}
+
+    def __setstate__(self, state):
+        self.__init__(state['data'])
+
+
+class _LazyLocations(object):
+    """Sequence of the locations in a ``BinaryGeolocationResult``"""
+
+    def __init__(self, result):
+        self.result = result
+
+    def __len__(self):
+        return len(self.result)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return map(self.result.location, xrange(*index.indices(len(self))))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('location index out of range')
+        return self.result.location(index)
+
+    def __iter__(self):
+        return iter(map(self.result.location, xrange(len(self))))
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class GeolocationBinaryCodec(GeolocationCodec):
+    """Compact binary codec for geolocation results
+
+    Encodes a ``GeolocationResult`` with positions, viewports and bounds as
+    fixed-width doubles and all names and types in a shared string table.
+    Decoding returns a ``BinaryGeolocationResult`` reading the data lazily.
+
+    The layout is a header (magic, number of locations, number of strings
+    and offset of the string table), a table of location offsets, the
+    locations and the string table. Each location is its position, flags
+    telling if it has a viewport and bounds, the number of address parts,
+    the viewport and bounds as north east and south west corners and the
+    string ids of the short name, long name and types of each part.
+    """
+    formats = ['binary']
+
     def decode(self, data):
-        return json.loads(data)
+        return BinaryGeolocationResult(data)
 
     def encode(self, data):
-        return json.dumps(data)
+        strings = {}
+        table = []
+
+        def string_id(value):
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            sid = strings.get(value)
+            if sid is None:
+                sid = strings[value] = len(table)
+                table.append(value)
+            return sid
+
+        locations = []
+        for location in data.locations:
+            boxes = [location.viewport, location.bounds]
+            flags = (boxes[0] and 1 or 0) | (boxes[1] and 2 or 0)
+            parts = location.address and location.address.parts or []
+            record = [_BINARY_LOCATION.pack(location.position.lat,
+                                            location.position.long,
+                                            flags, len(parts))]
+            for box in boxes:
+                if box:
+                    ne, sw = [box[corner] for corner in _BINARY_CORNERS]
+                    record.append(_BINARY_BOX.pack(ne.lat, ne.long, sw.lat, sw.long))
+            for part in parts:
+                types = ','.join(sorted(part.type or ()))
+                record.append(_BINARY_PART.pack(string_id(part.short),
+                                                string_id(part.long),
+                                                string_id(types)))
+            locations.append(''.join(record))
+
+        offset = _BINARY_HEADER.size + (len(locations) + 1) * _BINARY_OFFSET.size
+        offsets = []
+        for record in locations:
+            offsets.append(_BINARY_OFFSET.pack(offset))
+            offset += len(record)
+        offsets.append(_BINARY_OFFSET.pack(offset))
+
+        string_offsets = [0]
+        for value in table:
+            string_offsets.append(string_offsets[-1] + len(value))
+
+        return ''.join([_BINARY_HEADER.pack(_BINARY_MAGIC, len(locations),
+                                            len(table), offset)] +
+                       offsets + locations +
+                       map(_BINARY_OFFSET.pack, string_offsets) + table)
 
 
 def setup(codecs, registry=None):
@@ -113,7 +414,7 @@ def setup(codecs, registry=None):
 
     return registry
 
-setup([GeolocationJsonCodec], GeolocationCodecs)
+setup([GeolocationJsonCodec, GeolocationBinaryCodec], GeolocationCodecs)
 
 
 if __name__ == '__main__':
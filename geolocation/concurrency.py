@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+from __future__ import with_statement
+
+import Queue
+import collections
+import sys
+import threading
+
+from geolocation import abstract
+
+
+class TimeoutError(StandardError):
+    pass
+
+
+class CancelledError(StandardError):
+    pass
+
+
+class Future(object):
+    """Result of a call which may not have completed yet"""
+
+    def __init__(self):
+        super(Future, self).__init__()
+        self.__event = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+        self.__result = None
+        self.__exc_info = None
+
+    def done(self):
+        return self.__event.isSet()
+
+    def result(self, timeout=None):
+        """Wait for and return the result, raising the error if the call failed"""
+        self.wait(timeout)
+        if self.__exc_info:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+    def error(self, timeout=None):
+        """Wait for and return the error, or ``None`` if the call succeeded"""
+        self.wait(timeout)
+        return self.__exc_info and self.__exc_info[1]
+
+    def wait(self, timeout=None):
+        self.__event.wait(timeout)
+        if not self.__event.isSet():
+            raise TimeoutError('Result not available within %s seconds' % (timeout,))
+
+    def add_done_callback(self, callback):
+        """Call `callback` with the future once it is done"""
+        with self.__lock:
+            if not self.__event.isSet():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self.__result = result
+        self.__finish()
+
+    def set_exc_info(self, exc_info):
+        self.__exc_info = exc_info
+        self.__finish()
+
+    def __finish(self):
+        with self.__lock:
+            self.__event.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class WorkerPool(object):
+    """Fixed size pool of threads running submitted calls
+
+    Threads are started on the first submit. The pool can be shared, but
+    `shutdown` stops it for every user.
+    """
+
+    def __init__(self, size=8):
+        super(WorkerPool, self).__init__()
+        self.size = size
+        self.__queue = Queue.Queue()
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule a call, returning a ``Future`` for its result"""
+        future = Future()
+        with self.__lock:
+            if self.__shutdown:
+                raise RuntimeError('Cannot submit to a pool after shutdown')
+            if not self.__threads:
+                self.__start()
+            self.__queue.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop all threads, cancelling calls that have not started yet"""
+        with self.__lock:
+            self.__shutdown = True
+            threads, self.__threads = self.__threads, []
+            for thread in threads:
+                self.__queue.put(None)
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def __start(self):
+        for i in xrange(self.size):
+            thread = threading.Thread(target=self.__work)
+            thread.setDaemon(True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def __work(self):
+        while True:
+            task = self.__queue.get()
+            if task is None:
+                return
+
+            future, func, args, kwargs = task
+            if self.__shutdown:
+                future.set_exc_info((CancelledError,
+                                     CancelledError('Worker pool shut down'),
+                                     None))
+                continue
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+
+
+class SingleFlight(object):
+    """Share a call between threads making it at the same time
+
+    While a call for a key is running, other threads calling `do` with the
+    same key wait for it to finish and get its result, or its error, instead
+    of making the call themselves.
+    """
+
+    def __init__(self):
+        super(SingleFlight, self).__init__()
+        self.__calls = {}
+        self.__lock = threading.Lock()
+        self.coalesced = 0
+        """Number of calls answered by another thread's call"""
+
+    def do(self, key, func, *args, **kwargs):
+        with self.__lock:
+            future = self.__calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+            else:
+                self.__calls[key] = Future()
+
+        if future is not None:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            exc_info = sys.exc_info()
+            self.__finish(key).set_exc_info(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        self.__finish(key).set_result(result)
+        return result
+
+    def __finish(self, key):
+        with self.__lock:
+            return self.__calls.pop(key)
+
+
+class BatchResult(abstract.Dictable):
+    """Outcome of a single item in a batch
+
+    Exactly one of `result` and `error` is set.
+    """
+    def __init__(self, index, item, result=None, error=None):
+        self.index = index
+        self.item = item
+        self.result = result
+        self.error = error
+
+
+class _Reorder(object):
+    """Buffer results, releasing them in input order if `ordered`"""
+
+    def __init__(self, ordered):
+        self.ordered = ordered
+        self.ready = {}
+        self.next = 0
+
+    def add(self, result):
+        self.ready[result.index] = result
+
+    def release(self):
+        if self.ordered:
+            while self.next in self.ready:
+                self.next += 1
+                yield self.ready.pop(self.next - 1)
+        else:
+            while self.ready:
+                yield self.ready.popitem()[1]
+
+
+def batch_map(func, items, concurrency=8, ordered=True, key=None, buffer=None,
+              remember=None):
+    """Call `func` for every item in a pool of threads
+
+    Yields a ``BatchResult`` per item, either in input order or as soon as
+    each call completes. Items with the same key are only called once. A
+    failing call is yielded with its error instead of aborting the batch.
+
+    Items are consumed lazily, so at most `buffer` items are held at once.
+    To keep memory bounded for endless streams, give `remember` to only
+    keep that many of the latest results for later duplicates.
+
+    Closing the generator early cancels the calls not yet started and
+    waits for those running.
+
+    Arguments:
+        - `func`        -- called with each item as its only argument
+        - `items`       -- iterable of items
+        - `concurrency` -- number of concurrent calls
+        - `ordered`     -- yield results in input order
+        - `key`         -- create the deduplication key for an item
+        - `buffer`      -- max items read but not yet yielded
+        - `remember`    -- max results kept for duplicates (``None`` all)
+    """
+    if buffer is None:
+        buffer = concurrency * 4
+
+    pool = WorkerPool(concurrency)
+    completed = Queue.Queue()
+    reorder = _Reorder(ordered)
+    pending = {}
+    finished = {}
+    finished_keys = collections.deque()
+
+    def resolve():
+        k, future = completed.get()
+        error = future.error()
+        if error is None:
+            finished[k] = outcome = (future.result(), None)
+        else:
+            finished[k] = outcome = (None, error)
+        for index, item in pending.pop(k):
+            reorder.add(BatchResult(index, item, *outcome))
+
+        if remember is not None:
+            finished_keys.append(k)
+            if len(finished_keys) > remember:
+                del finished[finished_keys.popleft()]
+
+    try:
+        outstanding = 0
+        for index, item in enumerate(items):
+            if key is None:
+                k = item
+            else:
+                k = key(item)
+
+            outstanding += 1
+            if k in finished:
+                reorder.add(BatchResult(index, item, *finished[k]))
+            elif k in pending:
+                pending[k].append((index, item))
+            else:
+                pending[k] = [(index, item)]
+                future = pool.submit(func, item)
+                future.add_done_callback(lambda f, k=k: completed.put((k, f)))
+
+            for result in reorder.release():
+                outstanding -= 1
+                yield result
+
+            # anything still held back waits for a pending call
+            while outstanding >= buffer and pending:
+                resolve()
+                for result in reorder.release():
+                    outstanding -= 1
+                    yield result
+
+        while pending:
+            resolve()
+            for result in reorder.release():
+                yield result
+    finally:
+        pool.shutdown()
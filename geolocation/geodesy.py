@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+"""Geodesic calculations
+
+Distances, bearings and bounds tests for positions given as latitude and
+longitude in degrees. Distances are in meters.
+
+Every calculation has a scalar version working on single positions, and a
+batch version (suffixed ``_many``) working on sequences of positions. With
+NumPy_ installed the batch versions are vectorized and return arrays,
+otherwise they fall back to the scalar versions and return lists.
+
+.. _NumPy: http://numpy.scipy.org/
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from geolocation import orientation
+
+EARTH_RADIUS = 6371008.8
+"""Mean earth radius in meters"""
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distance on a spherical earth"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+
+def vincenty(lat1, lng1, lat2, lng2, iterations=200, tolerance=1e-12):
+    """Geodesic distance on the WGS-84 ellipsoid
+
+    Accurate to within millimeters, but returns NaN for nearly antipodal
+    positions where the iteration does not converge.
+    """
+    if lat1 == lat2 and lng1 == lng2:
+        return 0.0
+
+    L = math.radians(lng2 - lng1)
+    U1 = math.atan((1 - WGS84_F) * math.tan(math.radians(lat1)))
+    U2 = math.atan((1 - WGS84_F) * math.tan(math.radians(lat2)))
+    sinU1, cosU1 = math.sin(U1), math.cos(U1)
+    sinU2, cosU2 = math.sin(U2), math.cos(U2)
+
+    lam = L
+    for i in xrange(iterations):
+        sinLam, cosLam = math.sin(lam), math.cos(lam)
+        sinSigma = math.sqrt((cosU2 * sinLam) ** 2 +
+                             (cosU1 * sinU2 - sinU1 * cosU2 * cosLam) ** 2)
+        if sinSigma == 0:
+            return 0.0
+        cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLam
+        sigma = math.atan2(sinSigma, cosSigma)
+        sinAlpha = cosU1 * cosU2 * sinLam / sinSigma
+        cos2Alpha = 1 - sinAlpha ** 2
+        if cos2Alpha:
+            cos2SigmaM = cosSigma - 2 * sinU1 * sinU2 / cos2Alpha
+        else:
+            cos2SigmaM = 0.0
+        C = WGS84_F / 16 * cos2Alpha * (4 + WGS84_F * (4 - 3 * cos2Alpha))
+        previous = lam
+        lam = L + (1 - C) * WGS84_F * sinAlpha * \
+              (sigma + C * sinSigma * (cos2SigmaM + C * cosSigma *
+                                       (-1 + 2 * cos2SigmaM ** 2)))
+        if abs(lam - previous) < tolerance:
+            break
+    else:
+        return float('nan')
+
+    u2 = cos2Alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    deltaSigma = B * sinSigma * \
+                 (cos2SigmaM + B / 4 *
+                  (cosSigma * (-1 + 2 * cos2SigmaM ** 2) -
+                   B / 6 * cos2SigmaM * (-3 + 4 * sinSigma ** 2) *
+                   (-3 + 4 * cos2SigmaM ** 2)))
+    return WGS84_B * A * (sigma - deltaSigma)
+
+
+def initial_bearing(lat1, lng1, lat2, lng2):
+    """Initial bearing in degrees (0-360) of the great circle between two positions"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    y = math.sin(lng2 - lng1) * math.cos(lat2)
+    x = (math.cos(lat1) * math.sin(lat2) -
+         math.sin(lat1) * math.cos(lat2) * math.cos(lng2 - lng1))
+    return math.degrees(math.atan2(y, x)) % 360
+
+
+def destination(lat, lng, bearing, distance):
+    """Position reached going `distance` meters from a position along `bearing`
+
+    Returns a (lat, lng) tuple.
+    """
+    lat, lng, bearing = map(math.radians, (lat, lng, bearing))
+    delta = distance / EARTH_RADIUS
+    lat2 = math.asin(math.sin(lat) * math.cos(delta) +
+                     math.cos(lat) * math.sin(delta) * math.cos(bearing))
+    lng2 = lng + math.atan2(math.sin(bearing) * math.sin(delta) * math.cos(lat),
+                            math.cos(delta) - math.sin(lat) * math.sin(lat2))
+    return math.degrees(lat2), (math.degrees(lng2) + 540) % 360 - 180
+
+
+def compass_direction(bearing):
+    """Name of the ``orientation.Compass`` direction closest to a bearing"""
+    def difference(direction):
+        diff = abs(getattr(orientation.Compass, direction) - bearing % 360)
+        return min(diff, 360 - diff)
+    return min(sorted(orientation.Compass.directions), key=difference)
+
+
+def in_bounds(lat, lng, bounds):
+    """Check if a position is within bounds
+
+    The `bounds` are a dict with ``north_east`` and ``south_west`` corner
+    positions, like the `bounds` and `viewport` of ``Geolocation``. Bounds
+    crossing the 180th meridian are handled.
+    """
+    north_east, south_west = bounds['north_east'], bounds['south_west']
+    if not south_west.lat <= lat <= north_east.lat:
+        return False
+    if south_west.long <= north_east.long:
+        return south_west.long <= lng <= north_east.long
+    return lng >= south_west.long or lng <= north_east.long
+
+
+def distance(a, b, method=haversine):
+    """Distance between two ``GeolocationPosition``"""
+    return method(a.lat, a.long, b.lat, b.long)
+
+
+def bearing(a, b):
+    """Initial bearing from one ``GeolocationPosition`` to another"""
+    return initial_bearing(a.lat, a.long, b.lat, b.long)
+
+
+def _scalar_many(func, *args):
+    """Fallback for batch functions when NumPy is missing"""
+    args = list(args)
+    for i, arg in enumerate(args):
+        if not isinstance(arg, (int, long, float)):
+            args[i] = list(arg)
+
+    length = max([len(arg) for arg in args if isinstance(arg, list)])
+    for i, arg in enumerate(args):
+        if not isinstance(arg, list):
+            args[i] = [arg] * length
+
+    return map(func, *args)
+
+
+def haversine_many(lats1, lngs1, lats2, lngs2):
+    """Batch version of `haversine`, broadcasting scalars against sequences"""
+    if numpy is None:
+        return _scalar_many(haversine, lats1, lngs1, lats2, lngs2)
+
+    lat1, lng1, lat2, lng2 = map(numpy.radians, _arrays(lats1, lngs1, lats2, lngs2))
+    a = (numpy.sin((lat2 - lat1) / 2) ** 2 +
+         numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(1.0, a)))
+
+
+def vincenty_many(lats1, lngs1, lats2, lngs2, iterations=200, tolerance=1e-12):
+    """Batch version of `vincenty`"""
+    if numpy is None:
+        return _scalar_many(vincenty, lats1, lngs1, lats2, lngs2)
+
+    lat1, lng1, lat2, lng2 = numpy.broadcast_arrays(*_arrays(lats1, lngs1, lats2, lngs2))
+    L = numpy.radians(lng2 - lng1)
+    U1 = numpy.arctan((1 - WGS84_F) * numpy.tan(numpy.radians(lat1)))
+    U2 = numpy.arctan((1 - WGS84_F) * numpy.tan(numpy.radians(lat2)))
+    sinU1, cosU1 = numpy.sin(U1), numpy.cos(U1)
+    sinU2, cosU2 = numpy.sin(U2), numpy.cos(U2)
+
+    lam = L.copy()
+    converged = numpy.zeros(L.shape, dtype=bool)
+    old = numpy.seterr(divide='ignore', invalid='ignore')
+    try:
+        for i in xrange(iterations):
+            sinLam, cosLam = numpy.sin(lam), numpy.cos(lam)
+            sinSigma = numpy.sqrt((cosU2 * sinLam) ** 2 +
+                                  (cosU1 * sinU2 - sinU1 * cosU2 * cosLam) ** 2)
+            cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLam
+            sigma = numpy.arctan2(sinSigma, cosSigma)
+            sinAlpha = numpy.where(sinSigma == 0, 0.0,
+                                   cosU1 * cosU2 * sinLam / sinSigma)
+            cos2Alpha = 1 - sinAlpha ** 2
+            cos2SigmaM = numpy.where(cos2Alpha == 0, 0.0,
+                                     cosSigma - 2 * sinU1 * sinU2 / cos2Alpha)
+            C = WGS84_F / 16 * cos2Alpha * (4 + WGS84_F * (4 - 3 * cos2Alpha))
+            previous = lam
+            lam = numpy.where(converged, lam,
+                              L + (1 - C) * WGS84_F * sinAlpha *
+                              (sigma + C * sinSigma *
+                               (cos2SigmaM + C * cosSigma * (-1 + 2 * cos2SigmaM ** 2))))
+            converged |= numpy.abs(lam - previous) < tolerance
+            if converged.all():
+                break
+
+        u2 = cos2Alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        deltaSigma = B * sinSigma * \
+                     (cos2SigmaM + B / 4 *
+                      (cosSigma * (-1 + 2 * cos2SigmaM ** 2) -
+                       B / 6 * cos2SigmaM * (-3 + 4 * sinSigma ** 2) *
+                       (-3 + 4 * cos2SigmaM ** 2)))
+        result = WGS84_B * A * (sigma - deltaSigma)
+    finally:
+        numpy.seterr(**old)
+
+    result = numpy.where(sinSigma == 0, 0.0, result)
+    return numpy.where(converged, result, numpy.nan)
+
+
+def initial_bearing_many(lats1, lngs1, lats2, lngs2):
+    """Batch version of `initial_bearing`"""
+    if numpy is None:
+        return _scalar_many(initial_bearing, lats1, lngs1, lats2, lngs2)
+
+    lat1, lng1, lat2, lng2 = map(numpy.radians, _arrays(lats1, lngs1, lats2, lngs2))
+    y = numpy.sin(lng2 - lng1) * numpy.cos(lat2)
+    x = (numpy.cos(lat1) * numpy.sin(lat2) -
+         numpy.sin(lat1) * numpy.cos(lat2) * numpy.cos(lng2 - lng1))
+    return numpy.degrees(numpy.arctan2(y, x)) % 360
+
+
+def destination_many(lats, lngs, bearings, distances):
+    """Batch version of `destination`, returning arrays of (lats, lngs)"""
+    if numpy is None:
+        return tuple(map(list, zip(*_scalar_many(destination, lats, lngs,
+                                                 bearings, distances))))
+
+    lat, lng, bearing = map(numpy.radians, _arrays(lats, lngs, bearings))
+    delta = numpy.asarray(distances, dtype=float) / EARTH_RADIUS
+    lat2 = numpy.arcsin(numpy.sin(lat) * numpy.cos(delta) +
+                        numpy.cos(lat) * numpy.sin(delta) * numpy.cos(bearing))
+    lng2 = lng + numpy.arctan2(numpy.sin(bearing) * numpy.sin(delta) * numpy.cos(lat),
+                               numpy.cos(delta) - numpy.sin(lat) * numpy.sin(lat2))
+    return numpy.degrees(lat2), (numpy.degrees(lng2) + 540) % 360 - 180
+
+
+def compass_direction_many(bearings):
+    """Batch version of `compass_direction`"""
+    if numpy is None:
+        return map(compass_direction, bearings)
+
+    names = sorted(orientation.Compass.directions)
+    degrees = numpy.array([getattr(orientation.Compass, n) for n in names])
+    diff = numpy.abs(degrees - numpy.asarray(bearings, dtype=float)[..., None] % 360)
+    closest = numpy.minimum(diff, 360 - diff).argmin(axis=-1)
+    return numpy.array(names)[closest]
+
+
+def in_bounds_many(lats, lngs, bounds):
+    """Batch version of `in_bounds`, returning booleans"""
+    if numpy is None:
+        return [in_bounds(lat, lng, bounds) for lat, lng in zip(lats, lngs)]
+
+    lat, lng = _arrays(lats, lngs)
+    north_east, south_west = bounds['north_east'], bounds['south_west']
+    inside = (lat >= south_west.lat) & (lat <= north_east.lat)
+    if south_west.long <= north_east.long:
+        return inside & (lng >= south_west.long) & (lng <= north_east.long)
+    return inside & ((lng >= south_west.long) | (lng <= north_east.long))
+
+
+def _arrays(*args):
+    return [numpy.asarray(arg, dtype=float) for arg in args]
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+"""Geofences: which zones contain a position
+
+Zones are polygons, with holes and several parts, such as sales
+territories or delivery zones, read from GeoJSON_ or given as rings of
+(longitude, latitude) positions. A ``GeofenceIndex`` puts them in a grid
+so that only the zones whose bounding box covers the cell of a position
+are tested::
+
+    index = GeofenceIndex(read_geojson(open('zones.geojson')))
+    [zone.id for zone in index.zones_at(59.3145, 18.0865)]
+    index.zones_in(location.viewport)
+
+Like ``geolocation.geodesy``, the batch version (`zones_at_many`) is
+vectorized with NumPy when it is installed.
+
+Polygons are taken to be flat in latitude and longitude, and polygons
+crossing the 180th meridian have to be split along it, as GeoJSON
+requires. Positions on the edge of a zone may be either in or out.
+
+.. _GeoJSON: http://geojson.org/
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from geolocation import codecs
+
+_MAX_ELEMENTS = 1 << 20
+"""Max points times edges compared at once by the batch versions"""
+
+
+def _segment_in_box(x1, y1, x2, y2, west, south, east, north):
+    """Check if a segment touches a box, by clipping it (Liang-Barsky)"""
+    dx, dy = x2 - x1, y2 - y1
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x1 - west), (dx, east - x1),
+                 (-dy, y1 - south), (dy, north - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = float(q) / p
+        if p < 0:
+            if t > t1:
+                return False
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return False
+            t1 = min(t1, t)
+    return True
+
+
+def _boxes(bounds):
+    """Split ``north_east`` and ``south_west`` bounds into boxes
+
+    Returns (south, west, north, east) boxes, two of them for bounds
+    crossing the 180th meridian.
+    """
+    north_east, south_west = bounds['north_east'], bounds['south_west']
+    south, north = south_west.lat, north_east.lat
+    west, east = south_west.long, north_east.long
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+class Zone(object):
+    """Area made up of one or more polygons
+
+    Each polygon is a list of rings, the first being its outline and the
+    others its holes. A ring is a list of (longitude, latitude) positions,
+    in GeoJSON order, which need not repeat the first position at the end.
+    The polygons of a zone must not overlap.
+
+        - `id`          -- identifies the zone
+        - `properties`  -- any data of the zone, such as GeoJSON properties
+    """
+
+    def __init__(self, id, polygons, properties=None):
+        self.id = id
+        self.properties = properties or {}
+        self.polygons = polygons
+
+        # every ring counts for the even-odd rule, which handles holes and
+        # several polygons alike
+        edges = []
+        for polygon in polygons:
+            for ring in polygon:
+                ring = [(float(x), float(y)) for x, y in (p[:2] for p in ring)]
+                for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                    if (x1, y1) != (x2, y2):
+                        slope = y1 != y2 and (x2 - x1) / (y2 - y1) or 0.0
+                        edges.append((x1, y1, x2, y2, slope))
+        if not edges:
+            raise ValueError('Zone %r has no area' % (id,))
+
+        self.__edges = edges
+        self.__arrays = None
+        xs = [edge[0] for edge in edges]
+        ys = [edge[1] for edge in edges]
+        self.bbox = (min(ys), min(xs), max(ys), max(xs))
+        """Bounding box as (south, west, north, east)"""
+
+    def __repr__(self):
+        return 'Zone(id=%r)' % (self.id,)
+
+    def contains(self, lat, lng):
+        """Check if a position is within the zone"""
+        south, west, north, east = self.bbox
+        if not (south <= lat <= north and west <= lng <= east):
+            return False
+
+        inside = False
+        for x1, y1, x2, y2, slope in self.__edges:
+            if (y1 > lat) != (y2 > lat) and lng < x1 + (lat - y1) * slope:
+                inside = not inside
+        return inside
+
+    def contains_many(self, lats, lngs):
+        """Batch version of `contains`, returning an array of booleans"""
+        if numpy is None:
+            return map(self.contains, lats, lngs)
+
+        lats = numpy.asarray(lats, dtype=float)
+        lngs = numpy.asarray(lngs, dtype=float)
+        south, west, north, east = self.bbox
+        result = numpy.zeros(lats.shape, dtype=bool)
+        candidates = numpy.nonzero((lats >= south) & (lats <= north) &
+                                   (lngs >= west) & (lngs <= east))[0]
+        if not len(candidates):
+            return result
+
+        if self.__arrays is None:
+            x1, y1, x2, y2, slope = zip(*self.__edges)
+            self.__arrays = map(numpy.array, (x1, y1, y2, slope))
+        x1, y1, y2, slope = self.__arrays
+
+        step = max(1, _MAX_ELEMENTS // len(x1))
+        for start in xrange(0, len(candidates), step):
+            index = candidates[start:start + step]
+            lat = lats[index, None]
+            lng = lngs[index, None]
+            crossings = ((y1 > lat) != (y2 > lat)) & (lng < x1 + (lat - y1) * slope)
+            result[index] = crossings.sum(axis=1) & 1
+        return result
+
+    def intersects(self, bounds):
+        """Check if the zone overlaps bounds
+
+        The `bounds` are a dict with ``north_east`` and ``south_west``
+        corner positions, like the `viewport` and `bounds` of a
+        ``Geolocation``.
+        """
+        for box in _boxes(bounds):
+            if self.intersects_box(*box):
+                return True
+        return False
+
+    def intersects_box(self, south, west, north, east):
+        """Check if the zone overlaps a box"""
+        zone_south, zone_west, zone_north, zone_east = self.bbox
+        if (zone_south > north or zone_north < south or
+            zone_west > east or zone_east < west):
+            return False
+
+        for x1, y1, x2, y2, slope in self.__edges:
+            if _segment_in_box(x1, y1, x2, y2, west, south, east, north):
+                return True
+        # no edge within the box, so it is either wholly inside or outside
+        return self.contains(south, west)
+
+
+def read_geojson(data, id_property=None):
+    """Create a ``Zone`` of every polygon feature in GeoJSON
+
+    The `data` is a GeoJSON string, a file or already parsed GeoJSON: a
+    feature collection, a feature or a geometry. Features without a
+    ``Polygon`` or ``MultiPolygon`` geometry are skipped.
+
+    Zones are identified by the `id_property` of their properties if
+    given, otherwise by the feature id, or else their position in the
+    collection.
+    """
+    if hasattr(data, 'read'):
+        data = data.read()
+    if isinstance(data, basestring):
+        data = codecs.get_json_engine().loads(data)
+
+    kind = data.get('type')
+    if kind == 'FeatureCollection':
+        features = data.get('features') or []
+    elif kind == 'Feature':
+        features = [data]
+    else:
+        features = [{'type': 'Feature', 'geometry': data}]
+
+    zones = []
+    for index, feature in enumerate(features):
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+
+        properties = feature.get('properties') or {}
+        if id_property is not None:
+            id = properties.get(id_property)
+        else:
+            id = feature.get('id', index)
+        zones.append(Zone(id, polygons, properties))
+    return zones
+
+
+class GeofenceIndex(object):
+    """Grid index of zones
+
+    The world is divided into cells of `cell_size` degrees, each listing
+    the zones whose bounding box overlaps it. Zones covering more than
+    `max_cells` cells are instead tested for every position, after a check
+    of their bounding box. Without a `cell_size`, the median size of the
+    zones given is used.
+
+    Zones are returned in the order they were added.
+    """
+
+    def __init__(self, zones=(), cell_size=None, max_cells=4096):
+        zones = list(zones)
+        if cell_size is None:
+            cell_size = self.__median_size(zones)
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.__zones = []
+        self.__cells = {}
+        self.__large = []
+        for zone in zones:
+            self.add(zone)
+
+    def __len__(self):
+        return len(self.__zones)
+
+    def __iter__(self):
+        return iter(self.__zones)
+
+    def add(self, zone):
+        ordinal = len(self.__zones)
+        self.__zones.append(zone)
+
+        south, west, north, east = zone.bbox
+        rows = self.__span(south, north)
+        cols = self.__span(west, east)
+        if len(rows) * len(cols) > self.max_cells:
+            self.__large.append(ordinal)
+            return
+
+        for row in rows:
+            for col in cols:
+                self.__cells.setdefault((row, col), []).append(ordinal)
+
+    def zones_at(self, lat, lng):
+        """Get the zones containing a position"""
+        zones = self.__zones
+        return [zones[ordinal] for ordinal in self.__candidates(self.__cell(lat, lng))
+                if zones[ordinal].contains(lat, lng)]
+
+    def zones_at_position(self, position):
+        """Get the zones containing a ``GeolocationPosition``"""
+        return self.zones_at(position.lat, position.long)
+
+    def zones_at_many(self, lats, lngs):
+        """Batch version of `zones_at`, returning a list of zones per position
+
+        Positions are grouped by cell, testing each zone against all
+        positions of a cell at once.
+        """
+        if numpy is None:
+            return map(self.zones_at, lats, lngs)
+
+        lats = numpy.asarray(lats, dtype=float)
+        lngs = numpy.asarray(lngs, dtype=float)
+        results = [[] for i in xrange(len(lats))]
+        if not len(lats):
+            return results
+
+        rows = numpy.floor(lats / self.cell_size).astype(numpy.int64)
+        cols = numpy.floor(lngs / self.cell_size).astype(numpy.int64)
+        cells, inverse = numpy.unique(rows * (1 << 32) + cols, return_inverse=True)
+        order = numpy.argsort(inverse, kind='mergesort')
+        ends = numpy.cumsum(numpy.bincount(inverse))
+
+        start = 0
+        for end in ends:
+            index = order[start:end]
+            start = end
+            first = index[0]
+            for ordinal in self.__candidates((int(rows[first]), int(cols[first]))):
+                zone = self.__zones[ordinal]
+                inside = zone.contains_many(lats[index], lngs[index])
+                for i in index[inside]:
+                    results[i].append(zone)
+        return results
+
+    def zones_in(self, bounds):
+        """Get the zones overlapping bounds
+
+        The `bounds` are a dict with ``north_east`` and ``south_west``
+        corner positions, like the `viewport` and `bounds` of a
+        ``Geolocation``.
+        """
+        found = set()
+        for box in _boxes(bounds):
+            for ordinal in self.__box_candidates(*box):
+                if ordinal not in found and self.__zones[ordinal].intersects_box(*box):
+                    found.add(ordinal)
+        return [self.__zones[ordinal] for ordinal in sorted(found)]
+
+    def __cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lng / self.cell_size)))
+
+    def __span(self, low, high):
+        return xrange(int(math.floor(low / self.cell_size)),
+                      int(math.floor(high / self.cell_size)) + 1)
+
+    def __candidates(self, cell):
+        candidates = self.__cells.get(cell, ())
+        if self.__large:
+            return sorted(list(candidates) + self.__large)
+        return candidates
+
+    def __box_candidates(self, south, west, north, east):
+        rows = self.__span(south, north)
+        cols = self.__span(west, east)
+        if len(rows) * len(cols) > len(self.__cells):
+            return xrange(len(self.__zones))
+
+        candidates = set(self.__large)
+        for row in rows:
+            for col in cols:
+                candidates.update(self.__cells.get((row, col), ()))
+        return candidates
+
+    @staticmethod
+    def __median_size(zones):
+        if not zones:
+            return 1.0
+        sizes = sorted(max(north - south, east - west)
+                       for south, west, north, east in (z.bbox for z in zones))
+        return max(sizes[len(sizes) // 2], 1e-6)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+"""Geohash_ encoding of positions
+
+A geohash names a rectangular cell by interleaving the bits of the
+longitude and latitude, encoded in base 32. Every character added splits
+the cell into 32 smaller ones, so positions sharing a prefix are near each
+other.
+
+.. _Geohash: http://en.wikipedia.org/wiki/Geohash
+"""
+
+import math
+
+from geolocation import geodesy
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_DECODE = dict((c, i) for i, c in enumerate(BASE32))
+
+_METERS_PER_DEGREE = 2 * math.pi * geodesy.EARTH_RADIUS / 360
+
+
+def encode(latitude, longitude, length=9):
+    """Get the geohash of `length` characters of the cell holding a position"""
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < length:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if longitude >= mid:
+                value = value << 1 | 1
+                lng_lo = mid
+            else:
+                value <<= 1
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if latitude >= mid:
+                value = value << 1 | 1
+                lat_lo = mid
+            else:
+                value <<= 1
+                lat_hi = mid
+        even = not even
+
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = value = 0
+
+    return ''.join(chars)
+
+
+def bounds(geohash):
+    """Get the cell of a geohash as (south, west, north, east)"""
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    even = True
+    for char in geohash:
+        try:
+            value = _DECODE[char]
+        except KeyError:
+            raise ValueError('Invalid geohash: %r' % (geohash,))
+
+        for shift in (4, 3, 2, 1, 0):
+            bit = value >> shift & 1
+            if even:
+                mid = (lng_lo + lng_hi) / 2
+                if bit:
+                    lng_lo = mid
+                else:
+                    lng_hi = mid
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                if bit:
+                    lat_lo = mid
+                else:
+                    lat_hi = mid
+            even = not even
+
+    return lat_lo, lng_lo, lat_hi, lng_hi
+
+
+def decode(geohash):
+    """Get the center of the cell of a geohash as (latitude, longitude)"""
+    south, west, north, east = bounds(geohash)
+    return (south + north) / 2, (west + east) / 2
+
+
+def neighbors(geohash):
+    """Get the geohashes of the eight cells around a cell
+
+    Cells beyond the poles are left out, and longitudes wrap around the
+    antimeridian.
+    """
+    south, west, north, east = bounds(geohash)
+    height, width = north - south, east - west
+    lat, lng = (south + north) / 2, (west + east) / 2
+
+    cells = []
+    for dlat in (-1, 0, 1):
+        neighbor_lat = lat + dlat * height
+        if not -90 < neighbor_lat < 90:
+            continue
+        for dlng in (-1, 0, 1):
+            if dlat or dlng:
+                neighbor_lng = (lng + dlng * width + 180) % 360 - 180
+                cells.append(encode(neighbor_lat, neighbor_lng, len(geohash)))
+    return cells
+
+
+def cell_size(length, latitude=0.0):
+    """Get the (height, width) in meters of cells at a latitude
+
+    Cells are as high everywhere, but narrower away from the equator.
+    """
+    lat_bits = length * 5 // 2
+    lng_bits = length * 5 - lat_bits
+    return (180.0 / 2 ** lat_bits * _METERS_PER_DEGREE,
+            360.0 / 2 ** lng_bits * _METERS_PER_DEGREE *
+            math.cos(math.radians(min(abs(latitude), 90.0))))
+
+
+def length_for(meters, latitude=0.0):
+    """Get the longest geohash whose cells are at least `meters` across
+
+    The cells are measured at `latitude`, so they are as wide at least
+    everywhere closer to the equator.
+    """
+    length = 1
+    while length < 12 and min(cell_size(length + 1, latitude)) >= meters:
+        length += 1
+    return length
@@ -1,9 +1,25 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2009 Örjan Persson
 
+from __future__ import with_statement
+
+import collections
 import httplib
+import select
+import socket
 import threading
+import time
 import urllib
+import zlib
+
+from geolocation import concurrency
+from geolocation import metrics
+
+ACCEPT_ENCODING = 'gzip, deflate'
+"""Content codings asked for when compression is enabled"""
+
+PIPELINE_METHODS = ('GET', 'HEAD')
+"""Methods safe to pipeline, as they may be sent again after a failure"""
 
 
 class HttpClient(object):
@@ -12,7 +28,7 @@ class HttpClient(object):
 
     def encode_params(self, params):
         params = map(self.encode_param, params.iteritems())
-        return urllib.urlencode(dict(params))
+        return urllib.urlencode(sorted(params))
 
     def encode_param(self, item):
         key, value = item
@@ -22,6 +38,24 @@ class HttpClient(object):
             value = str(value)
         return (key, value)
 
+    def request_many(self, method, requests, *args, **kwargs):
+        """Perform several requests
+
+        Returns a ``geolocation.concurrency.BatchResult`` for each request
+        in order, with the response body or the error of the request.
+
+            - `requests`        -- iterable of (url, params)
+        """
+        results = []
+        for index, item in enumerate(requests):
+            try:
+                data = self.request(method, item[0], item[1], *args, **kwargs)
+            except Exception, e:
+                results.append(concurrency.BatchResult(index, item, error=e))
+            else:
+                results.append(concurrency.BatchResult(index, item, data))
+        return results
+
 
 class HttpConnection(HttpClient):
     default_port = 80
@@ -43,67 +77,474 @@ class HttpConnection(HttpClient):
 class Httplib_HttpConnection(httplib.HTTPConnection, HttpConnection):
     def __init__(self, addr, manager, *args, **kwargs):
         httplib.HTTPConnection.__init__(self, addr[0], addr[1], *args, **kwargs)
-        HttpConnection.__init__(self, addr, manager, *args, **kwargs)
+        HttpConnection.__init__(self, addr, manager)
 
 
 class Httplib_HttpsConnection(httplib.HTTPSConnection, HttpConnection):
     schema = 'https'
     def __init__(self, addr, manager, *args, **kwargs):
         httplib.HTTPSConnection.__init__(self, addr[0], addr[1], *args, **kwargs)
-        HttpConnection.__init__(self, addr, manager, *args, **kwargs)
+        HttpConnection.__init__(self, addr, manager)
+
+
+class HttpPoolTimeout(StandardError):
+    """No connection became available in time"""
+    pass
+
+
+class HttpContentEncodingError(StandardError):
+    """The body of a response could not be decompressed"""
+    pass
+
+
+class Decompressor(object):
+    """Decompresses a response body by its ``Content-Encoding``
+
+    Handles ``gzip`` and ``deflate``, for the latter both the zlib format
+    of the standard and the raw deflate data some servers send instead.
+    The body is given in chunks to `decompress`, followed by `flush`.
+    """
+
+    def __init__(self, encoding):
+        encoding = (encoding or 'identity').strip().lower()
+        self.__zlib = None
+        self.__pending = None
+        if encoding in ('gzip', 'x-gzip'):
+            self.__zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            # the format is told by the first two bytes
+            self.__pending = ''
+        elif encoding != 'identity':
+            raise HttpContentEncodingError('Unsupported content encoding: %s'
+                                           % (encoding,))
+
+    def decompress(self, data):
+        if self.__pending is not None:
+            data = self.__pending + data
+            if len(data) < 2:
+                self.__pending = data
+                return ''
+            self.__pending = None
+            self.__zlib = zlib.decompressobj(_is_zlib(data) and zlib.MAX_WBITS
+                                             or -zlib.MAX_WBITS)
+        if self.__zlib is None:
+            return data
+        try:
+            return self.__zlib.decompress(data)
+        except zlib.error, e:
+            raise HttpContentEncodingError('Invalid compressed response: %s'
+                                           % (e,))
+
+    def flush(self):
+        data = self.__pending and self.decompress('') or ''
+        if self.__zlib is None:
+            return data
+        return data + self.__zlib.flush()
+
+
+def _is_zlib(data):
+    """Check for a zlib header, as opposed to raw deflate data"""
+    header = ord(data[0]) << 8 | ord(data[1])
+    return header & 0x0f00 == 0x0800 and header % 31 == 0
+
+
+def decompress(data, encoding):
+    """Decompress a whole response body by its ``Content-Encoding``"""
+    decompressor = Decompressor(encoding)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+class _PipelineFile(object):
+    """Buffered file of a socket, shared by pipelined responses
+
+    Given to ``httplib.HTTPResponse`` in place of the socket, so that
+    reading ahead into the next response is not lost. Closing a response
+    leaves the file open for the next one.
+    """
+
+    def __init__(self, sock):
+        self.__fp = sock.makefile('rb')
+
+    def makefile(self, *args, **kwargs):
+        return self
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.__fp, name)
 
 
 class HttpConnectionManager(HttpClient):
+    """Pool of HTTP connections
+
+    Connections are kept alive and reused between requests. An idle
+    connection is checked before reuse, and a request failing on a reused
+    connection, which the server might have closed, is retried once on a
+    fresh one.
+
+    Unless `compress` is false, responses are asked for compressed with
+    gzip or deflate and decompressed before being returned. The bytes
+    received are counted as ``http.received_bytes`` and after
+    decompression as ``http.decoded_bytes`` by ``geolocation.metrics``.
+
+    With `request_many`, requests to the same host are pipelined over one
+    connection, sending up to `pipeline_depth` of them before reading the
+    first response.
+
+        - `schemas`         -- mapping of url schema to connection class
+        - `timeout`         -- socket timeout in seconds for new connections
+        - `max_connections` -- max connections per host (``None`` unbounded)
+        - `acquire_timeout` -- seconds to wait for a free connection when all
+                               are in use (``None`` waits forever)
+        - `max_idle`        -- seconds an idle connection is kept
+                               (``None`` keeps them until closed)
+        - `compress`        -- ask for compressed responses
+        - `pipeline_depth`  -- max requests sent ahead of their responses
+    """
     schemas = {'http': Httplib_HttpConnection,
                'https': Httplib_HttpsConnection}
 
-    def __init__(self, schemas=None, *args, **kwargs):
+    retry_errors = (httplib.BadStatusLine, socket.error)
+    """Errors on a reused connection causing the request to be retried"""
+
+    def __init__(self, schemas=None, timeout=None, max_connections=None,
+                 acquire_timeout=None, max_idle=60, compress=True,
+                 pipeline_depth=8, *args, **kwargs):
         super(HttpConnectionManager, self).__init__(*args, **kwargs)
         self.__connections = {}
-        self.__connections_lock = threading.Lock()
+        self.__in_use = {}
+        self.__connections_lock = threading.Condition()
+        self.__stats = dict.fromkeys(['created', 'reused', 'expired',
+                                      'stale', 'retried'], 0)
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+        self.max_idle = max_idle
+        self.compress = compress
+        self.pipeline_depth = pipeline_depth
 
         if schemas:
             self.schemas = schemas
 
     def get_connection(self, schema, addr, *args, **kwargs):
-        schema_cls = self.schemas[schema]
+        """Check out a connection to `addr`
+
+        Blocks while `max_connections` are in use for the host, raising
+        ``HttpPoolTimeout`` if none is returned within `acquire_timeout`.
+        """
+        try:
+            schema_cls = self.schemas[schema]
+        except KeyError:
+            raise AttributeError('Unsupported url schema: %s' % (schema,))
+
         addr = self.__cleanup_addr(addr, schema_cls.default_port)
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+
+        key = (schema, addr)
+        deadline = None
+        if self.acquire_timeout is not None:
+            deadline = time.time() + self.acquire_timeout
 
         with self.__connections_lock:
-            conns = self.__connections.setdefault((schema, addr), [])
+            conns = self.__connections.setdefault(key, [])
+            while True:
+                self.__expire(conns)
+                while conns:
+                    conn = conns.pop()[0]
+                    if self.__is_stale(conn):
+                        self.__stats['stale'] += 1
+                        conn.close()
+                        continue
 
-            if not conns:
-                try:
-                    conns.append(schema_cls(addr, self, *args, **kwargs))
-                except KeyError:
-                    raise AttributeError('Unsupported url schema: %s' % (schema,))
+                    self.__stats['reused'] += 1
+                    return self.__check_out(key, conn)
+
+                if (self.max_connections is None or
+                    self.__in_use.get(key, 0) < self.max_connections):
+                    self.__stats['created'] += 1
+                    return self.__check_out(key, schema_cls(addr, self, *args, **kwargs))
 
-            return conns.pop()
+                if deadline is None:
+                    self.__connections_lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise HttpPoolTimeout('No connection to %s:%s available '
+                                              'within %s seconds' % \
+                                              (addr + (self.acquire_timeout,)))
+                    self.__connections_lock.wait(remaining)
 
     def return_connection(self, conn):
-        addr = self.__cleanup_addr(conn.addr)
+        key = (conn.schema, self.__cleanup_addr(conn.addr))
+        with self.__connections_lock:
+            self.__in_use[key] -= 1
+            # a closed connection would only connect anew, so it is dropped
+            # rather than counted as reused
+            if conn.sock is not None:
+                self.__connections[key].append((conn, time.time()))
+            self.__connections_lock.notify()
+
+    def stats(self):
+        """Pool statistics
+
+        Returns a dict with the number of connections currently `in_use` and
+        `idle`, and counters of connections `created`, `reused`, `expired`
+        (idle too long), `stale` (closed by the server) and requests
+        `retried`.
+        """
         with self.__connections_lock:
-            self.__connections[(conn.schema, addr)].append(conn)
+            stats = dict(self.__stats)
+            stats['in_use'] = sum(self.__in_use.itervalues())
+            stats['idle'] = sum(map(len, self.__connections.itervalues()))
+        return stats
+
+    def close(self):
+        """Close all idle connections"""
+        with self.__connections_lock:
+            for conns in self.__connections.itervalues():
+                while conns:
+                    conns.pop()[0].close()
 
     def request(self, method, url, params=None, *args, **kwargs):
+        def read(response):
+            return response.read(), response.getheader('content-encoding')
+
+        conn, (data, encoding) = self.__send(method, url, params, args, kwargs,
+                                             read)
+        self.return_connection(conn)
+        return self.__decode_body(data, encoding)
+
+    def stream(self, method, url, params=None, chunk_size=8192, *args, **kwargs):
+        """Perform a request, yielding the response body in chunks
+
+        The connection is returned to the pool once the whole body has been
+        read. If the caller stops early, the connection is closed instead.
+        """
+        conn, response = self.__send(method, url, params, args, kwargs)
+        with conn:
+            complete = False
+            try:
+                decompressor = Decompressor(response.getheader('content-encoding'))
+                chunk = response.read(chunk_size)
+                while chunk:
+                    metrics.increment('http.received_bytes', len(chunk))
+                    chunk = decompressor.decompress(chunk)
+                    if chunk:
+                        metrics.increment('http.decoded_bytes', len(chunk))
+                        yield chunk
+                    chunk = response.read(chunk_size)
+                chunk = decompressor.flush()
+                if chunk:
+                    metrics.increment('http.decoded_bytes', len(chunk))
+                    yield chunk
+                complete = True
+            finally:
+                if not complete:
+                    conn.close()
+
+    def request_many(self, method, requests, depth=None):
+        """Perform several requests, pipelining those to the same host
+
+        Requests to the same host are sent over one connection, up to
+        `depth` (defaults to `pipeline_depth`) of them before the first
+        response is read, saving a round trip for each. Requests left
+        unanswered when the server closes the connection are sent again on
+        a new one, so only idempotent methods may be pipelined. A request
+        failing on a new connection before any response was read fails on
+        its own, and those after it are sent again. Any other error, such as
+        a truncated response, fails the requests waiting for a response on
+        the connection.
+
+        See ``HttpClient.request_many``.
+        """
+        if method not in PIPELINE_METHODS:
+            raise ValueError('Only %s requests may be pipelined'
+                             % (' and '.join(PIPELINE_METHODS),))
+
+        hosts = {}
+        count = 0
+        for item in requests:
+            schema, addr, path = self.__split_url(item[0])
+            if item[1]:
+                path += '?' + self.encode_params(item[1])
+            hosts.setdefault((schema, addr), []).append((count, path, item))
+            count += 1
+
+        results = [None] * count
+        for (schema, addr), queued in hosts.iteritems():
+            self.__pipeline(schema, addr, method, collections.deque(queued),
+                            depth or self.pipeline_depth, results)
+        return results
+
+    def __pipeline(self, schema, addr, method, queued, depth, results):
+        while queued:
+            with metrics.timed('http.acquire'):
+                conn = self.get_connection(schema, addr)
+            with conn:
+                reused = conn.sock is not None
+                remaining = len(queued)
+                sent = collections.deque()
+                try:
+                    self.__send_pipelined(conn, method, queued, sent, depth,
+                                          results)
+                except self.retry_errors, e:
+                    conn.close()
+                    if not reused and len(queued) + len(sent) == remaining:
+                        # nothing was answered, so blame the first request
+                        self.__fail(results, [(sent or queued).popleft()], e)
+                    else:
+                        with self.__connections_lock:
+                            self.__stats['retried'] += 1
+                except Exception, e:
+                    # the responses left on the connection cannot be read,
+                    # so the requests waiting for them fail
+                    conn.close()
+                    self.__fail(results, sent or [queued.popleft()], e)
+                    sent.clear()
+                finally:
+                    # unanswered requests are sent again on a new connection
+                    if sent:
+                        conn.close()
+                        queued.extendleft(reversed(sent))
+
+    def __fail(self, results, requests, error):
+        for index, path, item in requests:
+            results[index] = concurrency.BatchResult(index, item, error=error)
+
+    def __send_pipelined(self, conn, method, queued, sent, depth, results):
+        """Send queued requests over `conn`, reading responses in order
+
+        Requests are moved from `queued` to `sent` when sent, and removed
+        once answered.
+        """
+        if conn.sock is None:
+            conn.connect()
+
+        host = conn.host
+        if ':' in host:
+            host = '[%s]' % (host,)
+        if conn.port != conn.default_port:
+            host = '%s:%d' % (host, conn.port)
+        template = '%s %%s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: %s\r\n\r\n' % (
+            method, host, self.compress and ACCEPT_ENCODING or 'identity')
+
+        fp = _PipelineFile(conn.sock)
+        while queued or sent:
+            lines = []
+            while queued and len(sent) < depth:
+                sent.append(queued.popleft())
+                lines.append(template % (sent[-1][1],))
+            with metrics.timed('http.request'):
+                if lines:
+                    conn.sock.sendall(''.join(lines))
+                response = conn.response_class(fp, method=method)
+                response.begin()
+                data = response.read()
+                encoding = response.getheader('content-encoding')
+
+            index, path, item = sent.popleft()
+            try:
+                data = self.__decode_body(data, encoding)
+            except HttpContentEncodingError, e:
+                results[index] = concurrency.BatchResult(index, item, error=e)
+            else:
+                results[index] = concurrency.BatchResult(index, item, data)
+
+            if response.will_close:
+                conn.close()
+                return
+
+    def __send(self, method, url, params, args, kwargs, read=None):
+        """Send a request over a pooled connection
+
+        Returns the connection, still checked out, and the response, or
+        what `read` returns for it. A request failing on a reused
+        connection is retried once on a new one. Connections failing are
+        closed and given back.
+        """
         schema, addr, path = self.__split_url(url)
 
         if params:
             path += '?' + self.encode_params(params)
+        self.__accept_encoding(args, kwargs)
 
-        with self.get_connection(schema, addr) as conn:
-            conn.request(method, path, *args, **kwargs)
-            response = conn.getresponse()
-            data = response.read()
+        while True:
+            with metrics.timed('http.acquire'):
+                conn = self.get_connection(schema, addr)
+            reused = conn.sock is not None
+            sent = False
+            try:
+                with metrics.timed('http.request'):
+                    conn.request(method, path, *args, **kwargs)
+                    response = conn.getresponse()
+                    if read is not None:
+                        response = read(response)
+                sent = True
+                return conn, response
+            except self.retry_errors:
+                if not reused:
+                    raise
+                with self.__connections_lock:
+                    self.__stats['retried'] += 1
+            finally:
+                if not sent:
+                    # never put back a connection in the middle of a response
+                    conn.close()
+                    self.return_connection(conn)
 
+    def __accept_encoding(self, args, kwargs):
+        """Ask for compressed responses, unless headers are given positionally"""
+        if not self.compress or len(args) > 1:
+            return
+        headers = dict(kwargs.get('headers') or {})
+        for name in headers:
+            if name.lower() == 'accept-encoding':
+                return
+        headers['Accept-Encoding'] = ACCEPT_ENCODING
+        kwargs['headers'] = headers
+
+    def __decode_body(self, data, encoding):
+        metrics.increment('http.received_bytes', len(data))
+        if encoding:
+            data = decompress(data, encoding)
+        metrics.increment('http.decoded_bytes', len(data))
         return data
 
+    def __check_out(self, key, conn):
+        self.__in_use[key] = self.__in_use.get(key, 0) + 1
+        return conn
+
+    def __expire(self, conns):
+        if self.max_idle is None:
+            return
+        # connections are appended when returned, so the oldest come first
+        expired = time.time() - self.max_idle
+        while conns and conns[0][1] < expired:
+            self.__stats['expired'] += 1
+            conns.pop(0)[0].close()
+
+    def __is_stale(self, conn):
+        """Check if the server closed an idle connection
+
+        An idle keep-alive socket should have nothing to read. If it is
+        readable, the server has closed it or sent something unexpected.
+        """
+        if conn.sock is None:
+            return False
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
     def __cleanup_addr(self, addr, default_port=None):
         if isinstance(addr, basestring):
             addr = addr.split(':', 1)
         if len(addr) != 2:
             addr = (addr[0], default_port)
-        return addr
+        return (addr[0], int(addr[1]))
 
     def __split_url(self, url):
         """Split url into parts
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+"""Latency and throughput instrumentation
+
+Measurements are only taken while a sink has been added with `add_sink`,
+otherwise timers are shared no-ops. The request pipeline measures these
+stages, timers in seconds:
+
+    - ``provider.request``      -- whole lookup, labeled by `provider`
+    - ``http.acquire``          -- getting a connection from the pool
+    - ``http.request``          -- sending a request and reading the response
+    - ``http.received_bytes``   -- counter of response bytes as received
+    - ``http.decoded_bytes``    -- counter of response bytes decompressed
+    - ``decode.json``           -- parsing JSON
+    - ``decode.build``          -- creating result objects
+
+Every timer also counts ``<name>.errors`` when the timed code raises.
+"""
+
+from __future__ import with_statement
+
+import bisect
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_sinks = ()
+_sinks_lock = threading.Lock()
+
+
+def exponential_buckets(start=0.00001, factor=1.25, count=70):
+    """Upper bounds growing by `factor`, by default from 10µs to about 48s"""
+    return [start * factor ** i for i in xrange(count)]
+
+
+class Histogram(object):
+    """Histogram of observed values in fixed buckets
+
+    Each bucket counts the values up to its upper bound; larger values are
+    counted in a last, unbounded bucket. Percentiles are estimated as the
+    upper bound of the bucket they fall in. Safe to share between threads.
+    """
+
+    def __init__(self, buckets=None):
+        super(Histogram, self).__init__()
+        self.buckets = list(buckets or exponential_buckets())
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, percentile):
+        """Estimate the value below which `percentile` percent of values fall
+
+        Returns ``None`` if nothing has been observed.
+        """
+        counts, count, _ = self.snapshot()
+        if not count:
+            return None
+
+        rank = count * percentile / 100.
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return float('inf')
+                return self.buckets[index]
+
+    def mean(self):
+        return self.count and self.sum / self.count or None
+
+    def snapshot(self):
+        """Get a consistent (counts, count, sum) of the histogram"""
+        with self.__lock:
+            return list(self.counts), self.count, self.sum
+
+
+class Meter(object):
+    """Counts events per second over the last `size` seconds"""
+
+    def __init__(self, size=60):
+        super(Meter, self).__init__()
+        self.size = size
+        self.__seconds = [0] * size
+        self.__counts = [0] * size
+        self.__lock = threading.Lock()
+
+    def mark(self, value=1):
+        second = int(time.time())
+        index = second % self.size
+        with self.__lock:
+            if self.__seconds[index] != second:
+                self.__seconds[index] = second
+                self.__counts[index] = 0
+            self.__counts[index] += value
+
+    def rate(self, window=None):
+        """Average events per second during the last `window` seconds"""
+        window = min(window or self.size, self.size)
+        now = int(time.time())
+        with self.__lock:
+            total = sum(count for second, count in zip(self.__seconds, self.__counts)
+                        if now - window < second <= now)
+        return total / float(window)
+
+
+class Sink(object):
+    """Receives the measurements while it is added with `add_sink`
+
+    Labels are given as a sorted tuple of (name, value) pairs.
+    """
+
+    def increment(self, name, labels, value):
+        raise NotImplementedError()
+
+    def observe(self, name, labels, value):
+        raise NotImplementedError()
+
+
+class MemorySink(Sink):
+    """Keeps counters, histograms and rates in memory
+
+        >>> sink = metrics.add_sink(metrics.MemorySink())
+        >>> geocodes.get_by_address('Borgmästargatan, Stockholm')
+        >>> sink.histogram('http.request').percentile(99)
+        >>> sink.rate('provider.request', provider='google')
+    """
+
+    def __init__(self, window=60):
+        super(MemorySink, self).__init__()
+        self.window = window
+        self.counters = {}
+        self.histograms = {}
+        self.meters = {}
+        self.__lock = threading.Lock()
+
+    def increment(self, name, labels, value):
+        key = (name, labels)
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            meter = self.__meter(key)
+        meter.mark(value)
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self.__lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            meter = self.__meter(key)
+        histogram.observe(value)
+        meter.mark()
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, _labels(labels)), 0)
+
+    def histogram(self, name, **labels):
+        return self.histograms.get((name, _labels(labels)))
+
+    def rate(self, name, window=None, **labels):
+        """Counts or observations per second during the last `window` seconds"""
+        meter = self.meters.get((name, _labels(labels)))
+        return meter and meter.rate(window) or 0.0
+
+    def clear(self):
+        with self.__lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.meters.clear()
+
+    def __meter(self, key):
+        meter = self.meters.get(key)
+        if meter is None:
+            meter = self.meters[key] = Meter(self.window)
+        return meter
+
+
+class LoggingSink(Sink):
+    """Logs every measurement"""
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        super(LoggingSink, self).__init__()
+        self.logger = logger or log
+        self.level = level
+
+    def increment(self, name, labels, value):
+        self.logger.log(self.level, '%s%s +%s', name, _format_labels(labels), value)
+
+    def observe(self, name, labels, value):
+        self.logger.log(self.level, '%s%s %.6f', name, _format_labels(labels), value)
+
+
+class PrometheusExporter(object):
+    """Exports a ``MemorySink`` in the Prometheus text format
+
+    Names are prefixed with `prefix` and dots replaced by underscores.
+    Histograms of timers are in seconds.
+
+        >>> exporter = metrics.PrometheusExporter(sink)
+        >>> print exporter.render()
+    """
+
+    def __init__(self, sink, prefix='geolocation_'):
+        super(PrometheusExporter, self).__init__()
+        self.sink = sink
+        self.prefix = prefix
+
+    def render(self):
+        lines = []
+        for kind, series in (('counter', self.sink.counters),
+                             ('histogram', self.sink.histograms)):
+            typed = set()
+            for (name, labels), value in sorted(series.items()):
+                name = self.prefix + name.replace('.', '_')
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s %s' % (name, kind))
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (name, _format_labels(labels), value))
+                else:
+                    lines.extend(self.__histogram(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def __histogram(self, name, labels, histogram):
+        counts, count, total = histogram.snapshot()
+        seen = 0
+        for bound, bucket_count in zip(histogram.buckets + ['+Inf'], counts):
+            seen += bucket_count
+            le = labels + (('le', isinstance(bound, float) and '%g' % bound or bound),)
+            yield '%s_bucket%s %d' % (name, _format_labels(le), seen)
+        yield '%s_sum%s %r' % (name, _format_labels(labels), total)
+        yield '%s_count%s %d' % (name, _format_labels(labels), count)
+
+
+class _Timer(object):
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.start
+        for sink in _sinks:
+            sink.observe(self.name, self.labels, elapsed)
+            if exc_type is not None:
+                sink.increment(self.name + '.errors', self.labels, 1)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null_timer = _NullTimer()
+
+
+def _labels(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                                                         .replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def add_sink(sink):
+    """Start sending measurements to `sink`, returning it"""
+    global _sinks
+    with _sinks_lock:
+        _sinks = _sinks + (sink,)
+    return sink
+
+
+def remove_sink(sink):
+    global _sinks
+    with _sinks_lock:
+        _sinks = tuple(s for s in _sinks if s is not sink)
+
+
+def enabled():
+    """Check if any sink is receiving measurements"""
+    return bool(_sinks)
+
+
+def timed(name, **labels):
+    """Time a block of code, counting `name`.errors if it raises
+
+        >>> with metrics.timed('decode.json'):
+        ...     data = json.loads(data)
+
+    Without sinks, this returns a shared timer doing nothing.
+    """
+    if not _sinks:
+        return _null_timer
+    return _Timer(name, _labels(labels))
+
+
+def increment(name, value=1, **labels):
+    if _sinks:
+        labels = _labels(labels)
+        for sink in _sinks:
+            sink.increment(name, labels, value)
+
+
+def observe(name, value, **labels):
+    if _sinks:
+        labels = _labels(labels)
+        for sink in _sinks:
+            sink.observe(name, labels, value)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+import re
+import unicodedata
+
+from geolocation import geohash
+
+_separators = re.compile(r'[\W_]+', re.UNICODE)
+
+_casefold = {ord(u'ß'): u'ss', ord(u'ς'): u'σ'}
+
+_letters = {ord(u'æ'): u'ae', ord(u'ø'): u'o', ord(u'œ'): u'oe',
+            ord(u'đ'): u'd', ord(u'ł'): u'l', ord(u'þ'): u'th',
+            ord(u'ð'): u'd', ord(u'ı'): u'i'}
+"""Letters without a decomposition, replaced when stripping diacritics"""
+
+
+class AddressNormalizer(object):
+    """Reduces spellings of an address to a canonical form
+
+    Applies Unicode NFKC normalization and case folding, optionally strips
+    diacritics, and collapses punctuation and whitespace into single spaces.
+    With `reorder`, the words are also sorted so that word order does not
+    matter.
+
+        >>> normalizer = AddressNormalizer()
+        >>> normalizer('Borgmästargatan,  Stockholm')
+        'borgmastargatan stockholm'
+        >>> normalizer('BORGMASTARGATAN stockholm.')
+        'borgmastargatan stockholm'
+
+    Addresses are given and returned as UTF-8 encoded strings, though
+    unicode is accepted too. The normalized form is meant to identify an
+    address, e.g. as a cache key or when removing duplicates, while the
+    original address is what should be sent to the provider.
+    """
+
+    def __init__(self, reorder=False, strip_diacritics=True):
+        super(AddressNormalizer, self).__init__()
+        self.reorder = reorder
+        self.strip_diacritics = strip_diacritics
+
+    def __call__(self, address):
+        if isinstance(address, str):
+            address = address.decode('utf-8', 'replace')
+
+        address = unicodedata.normalize('NFKC', address).lower()
+        address = address.translate(_casefold)
+        if self.strip_diacritics:
+            address = u''.join(c for c in unicodedata.normalize('NFKD', address)
+                               if not unicodedata.combining(c))
+            address = address.translate(_letters)
+
+        words = _separators.sub(u' ', address).split()
+        if self.reorder:
+            words.sort()
+        return u' '.join(words).encode('utf-8')
+
+
+normalize_address = AddressNormalizer()
+"""Normalize an address with the default options, see ``AddressNormalizer``"""
+
+
+class PositionQuantizer(object):
+    """Snaps positions to a grid so that nearby positions become equal
+
+    Positions are either rounded to `decimals` places (4 places are about
+    11 meters of latitude), or moved to the center of their geohash cell of
+    `geohash_length` characters (see ``geolocation.geohash.cell_size``).
+
+        >>> quantize = PositionQuantizer(decimals=4)
+        >>> quantize(59.31454771, 18.08645213)
+        (59.3145, 18.0865)
+    """
+
+    def __init__(self, decimals=None, geohash_length=None):
+        super(PositionQuantizer, self).__init__()
+        if (decimals is None) == (geohash_length is None):
+            raise ValueError('Either decimals or geohash_length has to be given')
+        self.decimals = decimals
+        self.geohash_length = geohash_length
+
+    def __call__(self, latitude, longitude):
+        if self.decimals is not None:
+            return round(latitude, self.decimals), round(longitude, self.decimals)
+        return geohash.decode(geohash.encode(latitude, longitude,
+                                             self.geohash_length))
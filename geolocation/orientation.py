@@ -7,6 +7,8 @@ from geolocation import abstract
 
 
 class Geolocation(abstract.Dictable):
+    __slots__ = ('address', 'position', 'viewport', 'bounds')
+
     def __init__(self, address, position, bounds=None, viewport=None):
         self.address = address
         self.position = position
@@ -14,26 +16,96 @@ class Geolocation(abstract.Dictable):
         self.bounds = bounds
 
 
+def _lazy_field(name):
+    """Property reading a ``Geolocation`` slot, loading it if not yet set"""
+    slot = Geolocation.__dict__[name]
+
+    def get(self):
+        try:
+            return slot.__get__(self, Geolocation)
+        except AttributeError:
+            value = self._load(self._data, name)
+            slot.__set__(self, value)
+            return value
+
+    return property(get, slot.__set__)
+
+
+class LazyGeolocation(Geolocation):
+    """Geolocation creating its fields when first read
+
+    Each of `address`, `position`, `viewport` and `bounds` is created on
+    first access by calling `load` with `data` and the name of the field.
+    Pickling gives a plain ``Geolocation`` with all fields loaded.
+    """
+    __slots__ = ('_data', '_load')
+
+    def __init__(self, data, load):
+        self._data = data
+        self._load = load
+
+    address = _lazy_field('address')
+    position = _lazy_field('position')
+    viewport = _lazy_field('viewport')
+    bounds = _lazy_field('bounds')
+
+    def iterattrs(self):
+        for name in Geolocation.__slots__:
+            yield name, getattr(self, name)
+
+    def __reduce__(self):
+        return (Geolocation, (self.address, self.position, self.bounds,
+                              self.viewport))
+
+
 class GeolocationPosition(abstract.Dictable):
+    __slots__ = ('lat', 'long')
+
     def __init__(self, lat, long):
         self.lat = lat
         self.long = long
 
 
 class GeolocationAddress(abstract.Dictable):
+    __slots__ = ('parts',)
+
     def __init__(self, parts):
         self.parts = parts
 
 
 class GeolocationAddressPart(abstract.Dictable):
+    __slots__ = ('short', 'long', 'type')
+
     def __init__(self, short, long, types):
         self.short = short
         self.long = long
         self.type = types
 
 
+_address_types = {}
+
+
+def address_types(types):
+    """Get a shared frozenset for a list of address types
+
+    Providers create the types of every ``GeolocationAddressPart`` with
+    this, so that parts of the same types share one immutable set.
+    """
+    key = tuple(types)
+    shared = _address_types.get(key)
+    if shared is None:
+        shared = _address_types[key] = frozenset(intern(str(t)) for t in types)
+    return shared
+
+
 class CardinalDirections(object):
-    directions = set()
+    directions = set(['north', 'east', 'south', 'west', 'north_east',
+                      'north_west', 'south_west', 'south_east'])
+
+    north = 0.0
+    east = 90.0
+    south = 180.0
+    west = 270.0
 
     @classmethod
     def add_direction(cls, name, degree):
@@ -44,21 +116,13 @@ class CardinalDirections(object):
 
 
 class Compass(CardinalDirections):
-    pass
+    # precomputed from __sorted__, each cardinal direction 90 degrees from
+    # the previous one with north and south having neighbours 45 degrees to
+    # either side
+    north_east = 45.0
+    north_west = 315.0
+    south_west = 225.0
+    south_east = 135.0
 
 
 __sorted__ = ['north', 'east', 'south', 'west']
-for i, d in enumerate(__sorted__):
-    degree = math.degrees(i / 2. * math.pi)
-
-    CardinalDirections.add_direction(d, degree)
-    Compass.add_direction(d, degree)
-
-    left = __sorted__[i-1]
-    right = __sorted__[-1*(i-1)]
-
-    if left != right:
-        Compass.add_direction(d + '_' + right, degree + math.degrees((1 / 4.) * math.pi))
-        Compass.add_direction(d + '_' + left,  degree - math.degrees((1 / 4.) * math.pi))
-
-del i, d
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+"""Decoding of raw responses in a pool of processes
+
+Decoding responses is bound by the CPU, so a single process replaying
+archived responses cannot use more than one core. ``ProcessDecoder`` hands
+chunks of raw responses to a pool of processes and yields the results in
+the order of the responses::
+
+    decoder = ProcessDecoder(processes=4)
+    try:
+        for item in decoder.decode_many(responses):
+            print item.index, item.error or item.result[0][:2]
+    finally:
+        decoder.close()
+
+Results are sent back from the workers as plain tuples (see
+``to_tuples``) instead of as pickled object graphs, which take several
+times longer to pickle and unpickle than the response took to decode.
+Use ``from_tuples`` to get a ``GeolocationResult`` back, or ask for the
+results encoded with ``codecs.GeolocationBinaryCodec`` to store them.
+"""
+
+import collections
+import multiprocessing
+import signal
+
+import geolocation
+
+from geolocation import codecs
+from geolocation import concurrency
+from geolocation import orientation
+
+_decoder = None
+_encode = None
+
+
+def _box_tuple(box):
+    if not box:
+        return None
+    north_east, south_west = box['north_east'], box['south_west']
+    return (north_east.lat, north_east.long, south_west.lat, south_west.long)
+
+
+def _box(values):
+    if values is None:
+        return None
+    return {'north_east': orientation.GeolocationPosition(*values[:2]),
+            'south_west': orientation.GeolocationPosition(*values[2:])}
+
+
+def to_tuples(result):
+    """Get the locations of a result as tuples
+
+    Every location is ``(lat, long, viewport, bounds, parts)``, where the
+    viewport and bounds are ``(north east lat, north east long, south west
+    lat, south west long)`` or ``None``, and each address part is ``(short,
+    long, types)``. Like ``codecs.GeolocationBinaryCodec``, only the north
+    east and south west corners are kept.
+    """
+    return tuple((location.position.lat, location.position.long,
+                  _box_tuple(location.viewport), _box_tuple(location.bounds),
+                  tuple((part.short, part.long, tuple(part.type or ()))
+                        for part in location.address and
+                        location.address.parts or ()))
+                 for location in result.locations)
+
+
+def from_tuples(locations):
+    """Create a ``GeolocationResult`` from the tuples of ``to_tuples``"""
+    Part = orientation.GeolocationAddressPart
+    return geolocation.GeolocationResult([
+        orientation.Geolocation(
+            orientation.GeolocationAddress([Part(short, name, frozenset(types))
+                                            for short, name, types in parts]),
+            orientation.GeolocationPosition(lat, long),
+            _box(bounds), _box(viewport))
+        for lat, long, viewport, bounds, parts in locations])
+
+
+def _init_worker(decoder_class, binary):
+    global _decoder, _encode
+    # interrupts are handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _decoder = decoder_class('json')
+    if binary:
+        _encode = codecs.GeolocationBinaryCodec('binary').encode
+    else:
+        _encode = to_tuples
+
+
+def _decode_chunk(payloads):
+    """Decode a chunk of responses into (result, error) pairs"""
+    outcomes = []
+    for payload in payloads:
+        try:
+            outcomes.append((_encode(_decoder.decode(payload)), None))
+        except Exception, e:
+            outcomes.append((None, e))
+    return outcomes
+
+
+class ProcessDecoder(object):
+    """Decodes raw responses in a pool of processes
+
+        - `processes`       -- worker processes (defaults to the CPU count)
+        - `decoder_class`   -- decoder of the responses (defaults to
+                               ``GoogleGeocodeJsonDecoder``)
+        - `chunksize`       -- responses sent to a worker at a time
+        - `binary`          -- yield results encoded with
+                               ``codecs.GeolocationBinaryCodec`` instead
+                               of ``to_tuples``
+    """
+
+    def __init__(self, processes=None, decoder_class=None, chunksize=64,
+                 binary=False):
+        if decoder_class is None:
+            from geolocation.providers import google
+            decoder_class = google.GoogleGeocodeJsonDecoder
+
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.__pool = multiprocessing.Pool(self.processes, _init_worker,
+                                           (decoder_class, binary))
+
+    def decode_many(self, payloads, window=None):
+        """Decode every response in `payloads`
+
+        Yields a ``concurrency.BatchResult`` per response in input order,
+        with the response as the item. Responses failing to decode are
+        yielded with their error. Responses are read lazily, at most
+        `window` chunks (defaults to twice the processes) at a time.
+        """
+        if window is None:
+            window = self.processes * 2
+
+        running = collections.deque()
+        index = 0
+        for chunk in self.__chunks(payloads):
+            running.append((index, chunk,
+                            self.__pool.apply_async(_decode_chunk, (chunk,))))
+            index += len(chunk)
+            if len(running) >= window:
+                for result in self.__collect(*running.popleft()):
+                    yield result
+
+        while running:
+            for result in self.__collect(*running.popleft()):
+                yield result
+
+    def close(self):
+        """Stop the workers once they are done"""
+        self.__pool.close()
+        self.__pool.join()
+
+    def terminate(self):
+        """Stop the workers right away"""
+        self.__pool.terminate()
+        self.__pool.join()
+
+    def __chunks(self, payloads):
+        chunk = []
+        for payload in payloads:
+            chunk.append(payload)
+            if len(chunk) >= self.chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def __collect(self, index, chunk, pending):
+        # a timeout keeps the wait interruptible with Ctrl-C
+        outcomes = pending.get(1 << 31)
+        for offset, (result, error) in enumerate(outcomes):
+            yield concurrency.BatchResult(index + offset, chunk[offset],
+                                          result, error)
+
+
+def decode_many(payloads, processes=None, **kwargs):
+    """Decode responses with a ``ProcessDecoder`` for just this call"""
+    decoder = ProcessDecoder(processes, **kwargs)
+    try:
+        for result in decoder.decode_many(payloads):
+            yield result
+    except:
+        decoder.terminate()
+        raise
+    decoder.close()
@@ -2,7 +2,7 @@
 # Copyright (C) 2009 Örjan Persson
 
 from geolocation import abstract
-#from geolocation.providers import google
+from geolocation import concurrency as concurrency_
 
 class GeolocationProvider(object):
     """Converts between addresses and geocodes
@@ -17,6 +17,36 @@ class GeolocationProvider(object):
     def get_by_position(self, latitude, longitude):
         raise NotImplementedError()
 
+    def get_many_by_address(self, addresses, concurrency=8, ordered=True,
+                            key=None, **kwargs):
+        """Look up many addresses concurrently
+
+        Yields a ``geolocation.concurrency.BatchResult`` for every address,
+        with either the result or the error of the lookup. Each distinct
+        address is only looked up once.
+
+            - `addresses`       -- iterable of addresses
+            - `concurrency`     -- max number of simultaneous lookups
+            - `ordered`         -- yield in input order instead of as completed
+            - `key`             -- function telling which addresses are the
+                                   same, e.g. ``normalize.normalize_address``
+
+        Any other keyword arguments are passed on to `get_by_address`.
+        """
+        lookup = lambda address: self.get_by_address(address, **kwargs)
+        return concurrency_.batch_map(lookup, addresses, concurrency, ordered,
+                                      key=key)
+
+    def get_many_by_position(self, positions, concurrency=8, ordered=True,
+                             **kwargs):
+        """Look up many (latitude, longitude) positions concurrently
+
+        See `get_many_by_address`.
+        """
+        lookup = lambda position: self.get_by_position(*position, **kwargs)
+        return concurrency_.batch_map(lookup, positions, concurrency, ordered,
+                                      key=tuple)
+
 
 class GeolocationProviderManager(abstract.Factory):
     """Manager for all providers
@@ -24,7 +54,15 @@ class GeolocationProviderManager(abstract.Factory):
     Keep track of all providers available. Call the static `register` method
     if you wish to add a custom provider. To instantiate a provider, you can
     call `create` with the name of a previously registered provider.
+
+    Providers listed in `modules` are imported the first time they are
+    asked for, registering themselves. Use `register_module` to add more.
     """
+    modules = {'google': 'geolocation.providers.google',
+               'google-async': 'geolocation.providers.google',
+               'offline': 'geolocation.providers.offline',
+               'composite': 'geolocation.providers.composite'}
+    """Names of providers mapped to the modules registering them"""
 
     @classmethod
     def register(cls, name, provider):
@@ -35,3 +73,27 @@ class GeolocationProviderManager(abstract.Factory):
             - `provider`        -- GeolocationProvider
         """
         super(GeolocationProviderManager, cls).register(name, provider)
+
+    @classmethod
+    def register_module(cls, name, module):
+        """Register a provider to be imported on first use
+
+            - `module`          -- name of the module registering `name`
+        """
+        cls.modules[name] = module
+
+    @classmethod
+    def supports(cls, key):
+        return (key in cls.modules or
+                super(GeolocationProviderManager, cls).supports(key))
+
+    @classmethod
+    def get_class(cls, key):
+        if key not in cls.callables and key in cls.modules:
+            __import__(cls.modules[key])
+        return super(GeolocationProviderManager, cls).get_class(key)
+
+    @classmethod
+    def creatables(cls):
+        registered = super(GeolocationProviderManager, cls).creatables()
+        return sorted(set(cls.modules) | set(registered))
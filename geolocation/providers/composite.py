@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+from __future__ import with_statement
+
+import Queue
+import threading
+import time
+
+from geolocation import concurrency
+from geolocation import metrics
+from geolocation import providers
+
+
+class ProviderStats(object):
+    """Latency and error statistics of a provider
+
+    Besides a latency histogram, keeps a moving error rate which decays
+    towards zero over time, so that a provider which failed recently is
+    trusted again once `half_life` seconds have passed without errors.
+    """
+
+    def __init__(self, smoothing=0.2, half_life=60.0):
+        super(ProviderStats, self).__init__()
+        self.latency = metrics.Histogram()
+        self.calls = 0
+        self.errors = 0
+        self.smoothing = smoothing
+        self.half_life = half_life
+        self.__error_rate = 0.0
+        self.__updated = time.time()
+        self.__lock = threading.Lock()
+
+    def record(self, latency, failed):
+        with self.__lock:
+            self.calls += 1
+            self.errors += failed and 1 or 0
+            rate = self.__decayed(time.time())
+            self.__error_rate = rate + self.smoothing * ((failed and 1.0 or 0.0) - rate)
+        if not failed:
+            self.latency.observe(latency)
+
+    @property
+    def error_rate(self):
+        with self.__lock:
+            return self.__decayed(time.time())
+
+    def __decayed(self, now):
+        rate = self.__error_rate * 0.5 ** ((now - self.__updated) / self.half_life)
+        self.__error_rate, self.__updated = rate, now
+        return rate
+
+
+class CompositeGeocodes(providers.GeolocationProvider):
+    """Combines several providers for availability and latency
+
+    Providers are tried in the given order. If one fails, the next one is
+    asked instead. Providers whose recent error rate exceeds
+    `max_error_rate` are moved last until they recover.
+
+    With `hedge_percentile` set, a request which has not been answered
+    within that percentile of the latency of its provider is also sent to
+    the next provider, returning whichever answer arrives first. Hedging
+    starts once a provider has `hedge_min_samples` latency samples.
+
+        - `providers`           -- list of providers, see below
+        - `hedge_percentile`    -- latency percentile to hedge after
+        - `hedge_min_samples`   -- samples needed before hedging
+        - `max_error_rate`      -- error rate making a provider unhealthy
+        - `workers`             -- threads running hedged requests
+
+    Each provider is either a provider instance, the name of a registered
+    provider, or a tuple of a name and the keyword arguments to create it
+    with.
+
+        >>> finder = geolocation.GeolocationFinder('composite',
+        ...                                        ['google',
+        ...                                         ('offline', {'index': 'places.idx'})],
+        ...                                        hedge_percentile=95)
+    """
+    def __init__(self, providers_, hedge_percentile=None, hedge_min_samples=20,
+                 max_error_rate=0.5, workers=8):
+        if not providers_:
+            raise ValueError('At least one provider is needed')
+
+        self.providers = []
+        for provider in providers_:
+            if isinstance(provider, basestring):
+                provider = providers.GeolocationProviderManager.create(provider)
+            elif isinstance(provider, tuple):
+                name, kwargs = provider
+                provider = providers.GeolocationProviderManager.create(name, **kwargs)
+            self.providers.append(provider)
+
+        self.stats = dict((id(p), ProviderStats()) for p in self.providers)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.max_error_rate = max_error_rate
+        self.pool = hedge_percentile and concurrency.WorkerPool(workers) or None
+
+    def get_by_address(self, address, **kwargs):
+        return self.call('get_by_address', address, **kwargs)
+
+    def get_by_position(self, latitude, longitude, **kwargs):
+        return self.call('get_by_position', latitude, longitude, **kwargs)
+
+    def route(self):
+        """Providers in the order they should be tried"""
+        return sorted(self.providers, key=lambda p: (
+            self.stats[id(p)].error_rate > self.max_error_rate,
+            self.providers.index(p)))
+
+    def provider_stats(self, provider):
+        return self.stats[id(provider)]
+
+    def call(self, method, *args, **kwargs):
+        """Call a method on the providers until one of them succeeds
+
+        Raises the error of the last provider if all of them fail.
+        """
+        with metrics.timed('provider.request', provider='composite'):
+            return self.__call(self.route(), method, args, kwargs)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __call(self, order, method, args, kwargs):
+        if self.pool is not None:
+            return self.__hedged(order, method, args, kwargs)
+
+        for index, provider in enumerate(order):
+            try:
+                return self.__timed(provider, method, args, kwargs)
+            except Exception:
+                if index == len(order) - 1:
+                    raise
+
+    def __timed(self, provider, method, args, kwargs):
+        start = time.time()
+        try:
+            result = getattr(provider, method)(*args, **kwargs)
+        except Exception:
+            self.stats[id(provider)].record(time.time() - start, True)
+            raise
+
+        self.stats[id(provider)].record(time.time() - start, False)
+        return result
+
+    def __hedge_delay(self, provider):
+        latency = self.stats[id(provider)].latency
+        if latency.count < self.hedge_min_samples:
+            return None
+        return latency.percentile(self.hedge_percentile)
+
+    def __hedged(self, order, method, args, kwargs):
+        completed = Queue.Queue()
+        remaining = list(order)
+        running = 0
+
+        while True:
+            if remaining and not running:
+                provider = remaining.pop(0)
+                future = self.pool.submit(self.__timed, provider, method, args, kwargs)
+                future.add_done_callback(completed.put)
+                running += 1
+
+            delay = remaining and self.__hedge_delay(provider) or None
+            try:
+                future = completed.get(True, delay)
+            except Queue.Empty:
+                # too slow, also ask the next provider
+                provider = remaining.pop(0)
+                future = self.pool.submit(self.__timed, provider, method, args, kwargs)
+                future.add_done_callback(completed.put)
+                running += 1
+                continue
+
+            running -= 1
+            if future.error() is None or (not remaining and not running):
+                return future.result()
+
+
+providers.GeolocationProviderManager.register('composite', CompositeGeocodes)
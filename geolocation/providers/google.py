@@ -1,48 +1,133 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2009 Örjan Persson
 
+import functools
+
 import geolocation
 
 from geolocation import client
 from geolocation import codecs
+from geolocation import concurrency
+from geolocation import metrics
 from geolocation import orientation
 from geolocation import providers
+from geolocation import streaming
+
+
+# address types are shared with the other providers
+_types = orientation._address_types
+_address_types = orientation.address_types
+_names = {}
+_MAX_NAMES = 100000
+
+# google uses quite similar mapping (what an coincident!)
+_direction_mapping = dict((direction.replace('_', ''), direction)
+                          for direction in orientation.Compass.directions)
+
+
+def _name(name):
+    """Get a shared UTF-8 encoded string for a name"""
+    shared = _names.get(name)
+    if shared is None:
+        if len(_names) >= _MAX_NAMES:
+            _names.clear()
+        shared = _names[name] = intern(name.encode('utf-8'))
+    return shared
+
+
+FIELDS = ('address', 'position', 'viewport', 'bounds')
+"""Fields of a ``Geolocation`` which can be projected"""
 
 
 class GoogleGeocodeJsonDecoder(codecs.GeolocationCodecs.get_class('json')):
-    def __init__(self, *args, **kwargs):
-        super(GoogleGeocodeJsonDecoder, self).__init__(*args, **kwargs)
+    """Decodes Google geocode responses
+
+    If `fields` is given, only those fields (see `FIELDS`) of every
+    ``Geolocation`` are decoded, the others being ``None``.
+    """
+    result_class = geolocation.GeolocationResult
+    """Class of the decoded results"""
+
+    direction_mapping = _direction_mapping
+    """Google corner names mapped to ``orientation.Compass`` directions"""
+
+    fields = None
+    """Fields of every ``Geolocation`` to decode (``None`` for all)"""
 
-        # google uses quite similar mapping (what an coincident!)
-        self.direction_mapping = {}
-        for direction in orientation.Compass.directions:
-            self.direction_mapping[direction.replace('_', '')] = direction
+    def __init__(self, variant, fields=None):
+        super(GoogleGeocodeJsonDecoder, self).__init__(variant)
+        if fields is not None:
+            unknown = set(fields) - set(FIELDS)
+            if unknown:
+                raise ValueError('Unknown fields: %s' % (', '.join(unknown),))
+            self.fields = frozenset(fields)
 
     def decode(self, data):
         data = super(GoogleGeocodeJsonDecoder, self).decode(data)
+        self.check_status(data.get('status'))
+
+        with metrics.timed('decode.build'):
+            return self.build_result(data['results'])
+
+    def build_result(self, results):
+        return self.result_class(map(self.parse_result, results))
 
-        status = data.get('status')
+    def iter_decode(self, chunks, max_size=1 << 20):
+        """Decode a response incrementally, yielding each location
+
+        Locations are parsed as soon as they have been read from `chunks`,
+        keeping at most `max_size` bytes of the response in memory.
+        """
+        parser = streaming.JsonStreamParser(chunks, 'results', max_size)
+        found = False
+        for event in parser:
+            if event[0] == 'item':
+                found = True
+                yield self.parse_result(event[1])
+            elif event[1] == 'status' and (not found or event[2] != 'OK'):
+                self.check_status(event[2])
+
+    def check_status(self, status):
         if not status or status.lower() != 'ok':
             msg = 'Geocode retrieval failed with status: %s' % (status,)
+            if status == 'OVER_QUERY_LIMIT':
+                raise geolocation.GeolocationQuotaError(msg)
             raise geolocation.GeolocationError(msg)
 
-        locations = []
-        for result in data['results']:
-            address = self.parse_address(result['address_components'])
-            location, viewport, bounds = self.parse_geometry(result['geometry'])
-            locations.append(orientation.Geolocation(address, location, viewport, bounds))
-
-        return geolocation.GeolocationResult(locations)
+    def parse_result(self, result):
+        if self.fields is not None:
+            parse = self.parse_field
+            return orientation.Geolocation(parse(result, 'address'),
+                                           parse(result, 'position'),
+                                           parse(result, 'bounds'),
+                                           parse(result, 'viewport'))
+
+        address = self.parse_address(result['address_components'])
+        location, viewport, bounds = self.parse_geometry(result['geometry'])
+        return orientation.Geolocation(address, location, bounds, viewport)
+
+    def parse_field(self, result, name):
+        """Parse a single field of a result, ``None`` if not in `fields`"""
+        if self.fields is not None and name not in self.fields:
+            return None
+        if name == 'address':
+            return self.parse_address(result['address_components'])
+        if name == 'position':
+            return self.parse_location(result['geometry']['location'])
+        return self.parse_directions(result['geometry'].get(name))
 
     def parse_address(self, components):
+        # shared names and types are looked up inline, as calling out for
+        # every one of them is a large part of decoding a response
+        names, types = _names, _types
+        Part = orientation.GeolocationAddressPart
         parts = []
         for component in components:
-            short = component['short_name'].encode('utf-8')
-            long = component['long_name'].encode('utf-8')
-            types = set(component['types'])
-
-            part = orientation.GeolocationAddressPart(short, long, types)
-            parts.append(part)
+            short, long = component['short_name'], component['long_name']
+            kinds = component['types']
+            parts.append(Part(names.get(short) or _name(short),
+                              names.get(long) or _name(long),
+                              types.get(tuple(kinds)) or _address_types(kinds)))
 
         return orientation.GeolocationAddress(parts)
 
@@ -57,38 +142,84 @@ class GoogleGeocodeJsonDecoder(codecs.GeolocationCodecs.get_class('json')):
         if not data:
             return None
 
+        mapping, parse = self.direction_mapping, self.parse_location
         directions = {}
         for key, pos in data.iteritems():
-            name = self.direction_mapping[key]
-            assert name not in directions
-            directions[name] = self.parse_location(pos)
-
+            directions[mapping[key]] = parse(pos)
         return directions
 
     def parse_location(self, data):
         return orientation.GeolocationPosition(data['lat'], data['lng'])
 
 
+class GoogleGeocodeColumnarJsonDecoder(GoogleGeocodeJsonDecoder):
+    """Decodes into compact ``geolocation.ColumnarGeolocationResult``
+
+        >>> geocodes = GoogleGeocodes(decoders=[GoogleGeocodeColumnarJsonDecoder])
+    """
+    result_class = geolocation.ColumnarGeolocationResult
+
+
+class GoogleGeocodeLazyJsonDecoder(GoogleGeocodeJsonDecoder):
+    """Decodes into results created when first read
+
+    The locations of the ``geolocation.LazyGeolocationResult`` are created
+    on first access, and each field of an ``orientation.LazyGeolocation``
+    when first read, from the parsed response. Reading only the position
+    of a location never creates its address parts.
+
+        >>> geocodes = GoogleGeocodes(decoders=[GoogleGeocodeLazyJsonDecoder])
+    """
+
+    def build_result(self, results):
+        return geolocation.LazyGeolocationResult(results, self.parse_result)
+
+    def parse_result(self, result):
+        return orientation.LazyGeolocation(result, self.parse_field)
+
+
 class GoogleGeocodesClient(client.GeolocationHttpClient):
     URL = 'http://maps.google.com/maps/api/geocode/%(format)s'
     """Base URL"""
 
+    provider_name = 'google'
+
     def __init__(self, url=None, *args, **kwargs):
         super(GoogleGeocodesClient, self).__init__(*args, **kwargs)
         self.__url = url or self.URL
 
-    def request(self, codec=None, **kwargs):
+    def request(self, codec=None, key_params=None, **kwargs):
         variant = codec and codec.variant or 'json'
         url = self.__url % {'format': variant}
         return super(GoogleGeocodesClient, self).request('GET', url, kwargs,
-                                                         codec=codec or variant)
+                                                         codec=codec or variant,
+                                                         key_params=key_params)
+
+    def request_many(self, params_list, codec=None, key_params_list=None):
+        variant = codec and codec.variant or 'json'
+        url = self.__url % {'format': variant}
+        return super(GoogleGeocodesClient, self).request_many(
+            'GET', url, params_list, codec=codec or variant,
+            key_params_list=key_params_list)
+
+    def stream(self, codec=None, **kwargs):
+        variant = codec and codec.variant or 'json'
+        url = self.__url % {'format': variant}
+        return super(GoogleGeocodesClient, self).stream('GET', url, kwargs,
+                                                        codec=codec or variant)
+
+
+class AsyncGoogleGeocodesClient(GoogleGeocodesClient,
+                                client.AsyncGeolocationHttpClient):
+    pass
 
 
 def create_client(decoders=None, *args, **kwargs):
+    client_class = kwargs.pop('client_class', GoogleGeocodesClient)
     if not decoders:
         decoders = [GoogleGeocodeJsonDecoder]
 
-    return GoogleGeocodesClient(decoders=decoders, *args, **kwargs)
+    return client_class(decoders=decoders, *args, **kwargs)
 
 
 class GoogleGeocodes(providers.GeolocationProvider):
@@ -104,10 +235,48 @@ class GoogleGeocodes(providers.GeolocationProvider):
     data etc, you can easily pass your own retriever function in the
     constructor or override the `retrieve()` method.
 
+    If a `normalizer` (see ``geolocation.normalize``) is given, addresses
+    are identified by their normalized form in the cache and when
+    coalescing requests, so that different spellings of an address share
+    one lookup. The address is still sent as given.
+
+        >>> geocodes = GoogleGeocodes(cache=cache.MemoryCache(),
+        ...                           normalizer=normalize.normalize_address)
+
+    Likewise, a `quantizer` (see ``geolocation.normalize.PositionQuantizer``)
+    snaps positions to a grid before they are requested, so that slightly
+    different positions become the same request. A `reverse_cache` (see
+    ``geolocation.cache.ReverseCache``) answers positions near a previous
+    lookup without a request.
+
+        >>> geocodes = GoogleGeocodes(quantizer=normalize.PositionQuantizer(decimals=4),
+        ...                           reverse_cache=cache.ReverseCache(tolerance=25))
+
+    With `lazy`, results are decoded into objects created when first read
+    (see ``GoogleGeocodeLazyJsonDecoder``). Giving `fields` (see `FIELDS`)
+    decodes only those fields of every location, leaving the others
+    ``None``. Both only apply when no `decoders` are given. Results are
+    cached as decoded, so a cache should not be shared with providers
+    decoding other fields.
+
+        >>> geocodes = GoogleGeocodes(lazy=True, fields=['position'])
+
     .. _API: http://code.google.com/apis/maps/documentation/geocoding
     """
-    def __init__(self, decoders=None, *args, **kwargs):
-        self.client = create_client(decoders=decoders, *args, **kwargs)
+    client_class = GoogleGeocodesClient
+
+    def __init__(self, decoders=None, normalizer=None, quantizer=None,
+                 reverse_cache=None, lazy=False, fields=None, *args, **kwargs):
+        if decoders is None and (lazy or fields is not None):
+            decoder = lazy and GoogleGeocodeLazyJsonDecoder or GoogleGeocodeJsonDecoder
+            decoders = {'json': functools.partial(decoder, fields=fields)}
+
+        self.normalizer = normalizer
+        self.quantizer = quantizer
+        self.reverse_cache = reverse_cache
+        self.client = create_client(decoders=decoders,
+                                    client_class=self.client_class,
+                                    *args, **kwargs)
 
     def get_by_position(self, latitude, longitude, sensor=False, **kwargs):
         """Get address for a location by latitude and longitude
@@ -135,11 +304,176 @@ class GoogleGeocodes(providers.GeolocationProvider):
         .. _ccTLD: http://en.wikipedia.org/wiki/ccTLD
         .. _language: http://code.google.com/apis/maps/faq.html#languagesupport
         """
+        if self.quantizer is not None:
+            latitude, longitude = self.quantizer(latitude, longitude)
+
+        reverse_cache = self.reverse_cache
+        if reverse_cache is not None and not kwargs:
+            data = reverse_cache.get(latitude, longitude)
+            if data is not None:
+                return self._reverse_hit(data)
+
         latlng = ','.join(map(str, (latitude, longitude)))
-        return self.client.request(latlng=latlng, sensor=sensor, **kwargs)
+        data = self.client.request(latlng=latlng, sensor=sensor, **kwargs)
+        if reverse_cache is not None and not kwargs:
+            self._reverse_store(latitude, longitude, data)
+        return data
+
+    def _reverse_hit(self, data):
+        """Return a result found in the reverse cache"""
+        return data
+
+    def _reverse_store(self, latitude, longitude, data):
+        """Keep the result of a position in the reverse cache"""
+        self.reverse_cache.set(latitude, longitude, data)
 
     def get_by_address(self, address, sensor=False, **kwargs):
-        return self.client.request(address=address, sensor=sensor, **kwargs)
+        key_params = None
+        if self.normalizer is not None:
+            key_params = dict(kwargs, address=self.normalizer(address),
+                              sensor=sensor)
+        return self.client.request(address=address, sensor=sensor,
+                                   key_params=key_params, **kwargs)
+
+    def get_many_by_address(self, addresses, concurrency=8, ordered=True,
+                            key=None, pipeline=None, **kwargs):
+        """Look up many addresses concurrently
+
+        With `pipeline`, addresses are requested in groups of that many,
+        each pipelined over a single connection (see
+        ``geolocation.http.HttpConnectionManager.request_many``), with up
+        to `concurrency` groups at once. Requests refused due to the quota
+        are then not retried.
+
+        See ``providers.GeolocationProvider.get_many_by_address``.
+        """
+        if not pipeline:
+            return super(GoogleGeocodes, self).get_many_by_address(
+                addresses, concurrency, ordered, key=key, **kwargs)
+        return self.__get_pipelined(addresses, concurrency, ordered, key,
+                                    pipeline, kwargs)
+
+    def __get_pipelined(self, addresses, concurrency_, ordered, key, size,
+                        kwargs):
+        sensor = kwargs.pop('sensor', False)
+        key = key or self.normalizer
+
+        def lookup(group):
+            params_list = [dict(kwargs, address=address, sensor=sensor)
+                           for address in group[1]]
+            key_params_list = None
+            if key is not None:
+                key_params_list = [dict(params, address=key(params['address']))
+                                   for params in params_list]
+            return self.client.request_many(params_list,
+                                            key_params_list=key_params_list)
+
+        groups = concurrency.batch_map(lookup, _groups(addresses, size),
+                                       concurrency_, ordered,
+                                       key=lambda group: group[0])
+        for outcome in groups:
+            start, group = outcome.item
+            for index, address in enumerate(group):
+                if outcome.error is not None:
+                    yield concurrency.BatchResult(start + index, address,
+                                                  error=outcome.error)
+                else:
+                    result = outcome.result[index]
+                    yield concurrency.BatchResult(start + index, address,
+                                                  result.result, result.error)
+
+    def iter_by_position(self, latitude, longitude, sensor=False, **kwargs):
+        """Stream the locations for a position
+
+        Works like `get_by_position`, but yields each ``Geolocation`` as
+        soon as it has been read from the response. If you stop iterating
+        early, the rest of the response is never read or decoded.
+
+            >>> geocodes.iter_by_position(59.3145477, 18.0864521).next().position
+        """
+        if self.quantizer is not None:
+            latitude, longitude = self.quantizer(latitude, longitude)
+        latlng = ','.join(map(str, (latitude, longitude)))
+        return self.client.stream(latlng=latlng, sensor=sensor, **kwargs)
+
+    def iter_by_address(self, address, sensor=False, **kwargs):
+        """Stream the locations for an address, see `iter_by_position`"""
+        return self.client.stream(address=address, sensor=sensor, **kwargs)
+
+
+def _groups(items, size):
+    """Yield (index of the first item, items) of up to `size` items"""
+    group = []
+    start = 0
+    for item in items:
+        group.append(item)
+        if len(group) == size:
+            yield start, group
+            start += size
+            group = []
+    if group:
+        yield start, group
+
+
+class AsyncGoogleGeocodes(GoogleGeocodes):
+    """Asynchronous variant of ``GoogleGeocodes``
+
+    `get_by_address` and `get_by_position` return a
+    ``geolocation.concurrency.Future`` instead of blocking, see
+    ``geolocation.client.AsyncGeolocationHttpClient`` for the options.
+
+        >>> geocodes = AsyncGoogleGeocodes(per_host=2, timeout=5)
+        >>> future = geocodes.get_by_address('Borgmästargatan, Stockholm')
+        >>> future.result(timeout=10).locations[0].position
+    """
+    client_class = AsyncGoogleGeocodesClient
+
+    def get_many_by_address(self, addresses, concurrency=8, ordered=True,
+                            key=None, pipeline=None, **kwargs):
+        """Look up many addresses concurrently
+
+        Unlike `get_by_address`, every ``BatchResult`` holds the result or
+        error of its lookup, not a future. See
+        ``GoogleGeocodes.get_many_by_address``.
+        """
+        if pipeline:
+            return super(AsyncGoogleGeocodes, self).get_many_by_address(
+                addresses, concurrency, ordered, key=key, pipeline=pipeline,
+                **kwargs)
+        lookup = lambda address: self.get_by_address(address, **kwargs)
+        return self.__resolve_many(lookup, addresses, concurrency, ordered, key)
+
+    def get_many_by_position(self, positions, concurrency=8, ordered=True,
+                             **kwargs):
+        """Look up many (latitude, longitude) positions concurrently
+
+        See `get_many_by_address`.
+        """
+        lookup = lambda position: self.get_by_position(*position, **kwargs)
+        return self.__resolve_many(lookup, positions, concurrency, ordered,
+                                   tuple)
+
+    def __resolve_many(self, lookup, items, concurrency_, ordered, key):
+        # waits for the future of every lookup, which the client resolves
+        # in its own workers
+        return concurrency.batch_map(lambda item: lookup(item).result(), items,
+                                     concurrency_, ordered, key=key)
+
+    def _reverse_hit(self, data):
+        future = concurrency.Future()
+        future.set_result(data)
+        return future
+
+    def _reverse_store(self, latitude, longitude, future):
+        # only results of successful lookups are kept, once they are done
+        def store(future):
+            if future.error() is None:
+                self.reverse_cache.set(latitude, longitude, future.result())
+        future.add_done_callback(store)
+
+    def close(self):
+        self.client.close()
 
 
 providers.GeolocationProviderManager.register('google', GoogleGeocodes)
+providers.GeolocationProviderManager.register('google-async', AsyncGoogleGeocodes)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+from __future__ import with_statement
+
+import codecs
+import math
+import mmap
+import struct
+import threading
+
+import geolocation
+
+from geolocation import geodesy
+from geolocation import metrics
+from geolocation import orientation
+from geolocation import providers
+
+_MAGIC = 'GEOGAZ01'
+_HEADER = struct.Struct('<8sII')
+_POINT = struct.Struct('<3d')
+_RECORD = struct.Struct('<2d4I')
+_OFFSET = struct.Struct('<I')
+_NONE = 0xffffffff
+
+_COLUMNS = [('locality', orientation.address_types(['locality', 'political'])),
+            ('administrative_area_level_1', orientation.address_types(
+                ['administrative_area_level_1', 'political'])),
+            ('country', orientation.address_types(['country', 'political']))]
+
+
+def _to_xyz(lat, lng):
+    lat, lng = math.radians(lat), math.radians(lng)
+    return (math.cos(lat) * math.cos(lng),
+            math.cos(lat) * math.sin(lng),
+            math.sin(lat))
+
+
+def read_gazetteer(fileobj):
+    """Read places from a gazetteer file
+
+    The file is UTF-8 encoded and has one place per line, with the tab
+    separated columns latitude, longitude, locality, region
+    (administrative_area_level_1), country and country code. Empty lines and
+    lines starting with ``#`` are skipped, and trailing columns may be left
+    out.
+
+    Yields tuples of (lat, lng, locality, region, country, country_code)
+    with missing names as ``None``.
+    """
+    for line in codecs.getreader('utf-8')(fileobj):
+        line = line.rstrip(u'\r\n')
+        if not line or line.startswith(u'#'):
+            continue
+
+        columns = line.split(u'\t')
+        names = [c.strip() or None for c in columns[2:6]]
+        names += [None] * (4 - len(names))
+        yield tuple([float(columns[0]), float(columns[1])] + names)
+
+
+class GazetteerIndex(object):
+    """Spatial index of places for nearest place queries
+
+    Places are stored in a compact binary format as an implicit k-d tree
+    over points on the unit sphere, so the index can be searched directly
+    from a memory-mapped file without being loaded. Use `build` to create
+    the binary data from gazetteer rows, and `open` to map a file.
+
+    The binary format consists of a header (magic, number of places and
+    number of strings), the tree of points as three doubles each, the
+    places as latitude, longitude and four string ids, and finally a table
+    of string offsets followed by the UTF-8 encoded strings.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        magic, self.count, strings = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise geolocation.GeolocationError('Not a gazetteer index')
+
+        self.__points = _HEADER.size
+        self.__records = self.__points + self.count * _POINT.size
+        self.__offsets = self.__records + self.count * _RECORD.size
+        self.__strings = self.__offsets + (strings + 1) * _OFFSET.size
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def open(cls, path):
+        """Memory-map an index file written by `build`"""
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @staticmethod
+    def build(rows):
+        """Build the binary index for gazetteer rows
+
+        See `read_gazetteer` for the format of the rows.
+        """
+        strings = {}
+        table = []
+
+        def string_id(value):
+            if value is None:
+                return _NONE
+            sid = strings.get(value)
+            if sid is None:
+                sid = strings[value] = len(table)
+                table.append(value.encode('utf-8'))
+            return sid
+
+        places = [_to_xyz(row[0], row[1]) + (row[0], row[1]) +
+                  tuple(map(string_id, row[2:6])) for row in rows]
+
+        # sort every range on the median of the axis of its depth, making
+        # the middle of each range the root of its subtree
+        stack = [(0, len(places), 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if hi - lo < 2:
+                continue
+            places[lo:hi] = sorted(places[lo:hi], key=lambda p: p[axis])
+            mid = (lo + hi) // 2
+            stack.append((lo, mid, (axis + 1) % 3))
+            stack.append((mid + 1, hi, (axis + 1) % 3))
+
+        parts = [_HEADER.pack(_MAGIC, len(places), len(table))]
+        parts.extend(_POINT.pack(*p[:3]) for p in places)
+        parts.extend(_RECORD.pack(*p[3:]) for p in places)
+
+        offset = 0
+        for value in table:
+            parts.append(_OFFSET.pack(offset))
+            offset += len(value)
+        parts.append(_OFFSET.pack(offset))
+        parts.extend(table)
+
+        return ''.join(parts)
+
+    def nearest(self, lat, lng):
+        """Find the place closest to a position
+
+        Returns a tuple of the index of the place and its distance in
+        meters, or ``None`` if the index is empty.
+        """
+        x, y, z = target = _to_xyz(lat, lng)
+        unpack, size, data, base = (_POINT.unpack_from, _POINT.size,
+                                    self.data, self.__points)
+        best, best_dist = None, 5.0
+
+        # entries are (lo, hi, axis, least possible distance of the range)
+        stack = [(0, self.count, 0, 0.0)]
+        while stack:
+            lo, hi, axis, bound = stack.pop()
+            if lo >= hi or bound >= best_dist:
+                continue
+
+            mid = (lo + hi) >> 1
+            point = unpack(data, base + mid * size)
+            dist = ((point[0] - x) ** 2 + (point[1] - y) ** 2 +
+                    (point[2] - z) ** 2)
+            if dist < best_dist:
+                best, best_dist = mid, dist
+
+            diff = target[axis] - point[axis]
+            next_axis = (axis + 1) % 3
+            if diff < 0:
+                stack.append((mid + 1, hi, next_axis, diff * diff))
+                stack.append((lo, mid, next_axis, 0.0))
+            else:
+                stack.append((lo, mid, next_axis, diff * diff))
+                stack.append((mid + 1, hi, next_axis, 0.0))
+
+        if best is None:
+            return None
+
+        chord = math.sqrt(best_dist)
+        return best, 2 * math.asin(min(1.0, chord / 2)) * geodesy.EARTH_RADIUS
+
+    def place(self, index):
+        """Get the (lat, lng, locality, region, country, country_code) of a place"""
+        record = _RECORD.unpack_from(self.data, self.__records + index * _RECORD.size)
+        return record[:2] + tuple(map(self.string, record[2:]))
+
+    def string(self, sid):
+        if sid == _NONE:
+            return None
+        start, end = struct.unpack_from('<2I', self.data,
+                                        self.__offsets + sid * _OFFSET.size)
+        return self.data[self.__strings + start:self.__strings + end]
+
+
+class OfflineGeocodes(providers.GeolocationProvider):
+    """Reverse geocoding without network access
+
+    Finds the closest place in a local gazetteer, giving its locality,
+    region and country as a ``GeolocationResult`` just like the other
+    providers. The address parts use the same types as Google.
+
+    Either give the path of a binary `index` built by ``GazetteerIndex``,
+    which is memory-mapped, or of a `gazetteer` text file which is indexed
+    in memory. Nothing is loaded before the first lookup.
+
+        - `index`           -- binary index file
+        - `gazetteer`       -- gazetteer file, see `read_gazetteer`
+        - `max_distance`    -- meters to the closest place to accept
+
+        >>> geocodes = OfflineGeocodes(index='places.idx')
+        >>> geocodes.get_by_position(59.3145477, 18.0864521).locations[0].address
+    """
+    def __init__(self, index=None, gazetteer=None, max_distance=None):
+        if not index and not gazetteer:
+            raise ValueError('Either index or gazetteer has to be given')
+
+        self.index_path = index
+        self.gazetteer_path = gazetteer
+        self.max_distance = max_distance
+        self.__index = None
+        self.__lock = threading.Lock()
+
+    @property
+    def index(self):
+        if self.__index is None:
+            with self.__lock:
+                if self.__index is None:
+                    self.__index = self.__load()
+        return self.__index
+
+    def get_by_position(self, latitude, longitude, **kwargs):
+        """Get the address of the place closest to a position"""
+        with metrics.timed('provider.request', provider='offline'):
+            return self.__get_by_position(latitude, longitude)
+
+    def __get_by_position(self, latitude, longitude):
+        nearest = self.index.nearest(latitude, longitude)
+        if nearest is None or (self.max_distance is not None and
+                               nearest[1] > self.max_distance):
+            raise geolocation.GeolocationError('No place found near %s,%s' % \
+                                               (latitude, longitude))
+
+        place = self.index.place(nearest[0])
+        parts = []
+        for name, (column, types) in zip(place[2:5], _COLUMNS):
+            if name is None:
+                continue
+            short = name
+            if column == 'country' and place[5] is not None:
+                short = place[5]
+            parts.append(orientation.GeolocationAddressPart(short, name, types))
+
+        position = orientation.GeolocationPosition(place[0], place[1])
+        address = orientation.GeolocationAddress(parts)
+        return geolocation.GeolocationResult([orientation.Geolocation(address, position)])
+
+    def __load(self):
+        if self.index_path:
+            return GazetteerIndex.open(self.index_path)
+
+        with open(self.gazetteer_path, 'rb') as f:
+            return GazetteerIndex(GazetteerIndex.build(read_gazetteer(f)))
+
+
+providers.GeolocationProviderManager.register('offline', OfflineGeocodes)
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        print >> sys.stderr, 'usage: %s GAZETTEER INDEX' % (sys.argv[0],)
+        sys.exit(1)
+
+    with open(sys.argv[1], 'rb') as f:
+        data = GazetteerIndex.build(read_gazetteer(f))
+    with open(sys.argv[2], 'wb') as f:
+        f.write(data)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+from __future__ import with_statement
+
+import random
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter
+
+    Allows `rate` requests per second on average with bursts of up to
+    `burst` requests. Safe to share between threads; waiting threads are
+    served in the order they asked.
+
+        - `rate`            -- requests per second
+        - `burst`           -- bucket size (defaults to `rate`)
+        - `backoff`         -- first delay in seconds after being throttled
+        - `max_backoff`     -- max delay in seconds after being throttled
+    """
+
+    def __init__(self, rate, burst=None, backoff=1.0, max_backoff=60.0):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self.__tokens = self.burst
+        self.__updated = time.time()
+
+    def acquire(self, tokens=1):
+        """Take tokens from the bucket, sleeping until they are available"""
+        with self._lock:
+            now = time.time()
+            self.__tokens = min(self.burst, self.__tokens +
+                                (now - self.__updated) * self.rate)
+            self.__updated = now
+
+            # reserve the tokens right away, going into debt if needed, so
+            # that threads arriving later have to wait for this one
+            self.__tokens -= tokens
+            delay = -self.__tokens / self.rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self, attempt=0):
+        """Report that the provider refused a request due to its quota
+
+        Returns the number of seconds to wait before trying again. The delay
+        grows exponentially with the number of the `attempt`, with full
+        jitter so that throttled threads do not retry in lockstep.
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(0, delay)
+
+    def succeeded(self):
+        """Report that a request went through"""
+        pass
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """Rate limiter adapting to the quota of the provider
+
+    Being throttled multiplies the rate by `decrease`, at most once per
+    `cooldown` seconds since concurrent requests tend to be throttled
+    together. Successful requests raise the rate again by about `increase`
+    per second, slowly finding the highest rate the provider accepts.
+
+        - `min_rate`        -- lowest rate to back off to
+        - `max_rate`        -- highest rate to recover to (defaults to `rate`)
+        - `decrease`        -- factor applied to the rate when throttled
+        - `increase`        -- rate added per second of successful requests
+                               (defaults to a twentieth of `max_rate`)
+        - `cooldown`        -- seconds between two decreases
+
+    For the other arguments, see ``TokenBucket``.
+    """
+
+    def __init__(self, rate, min_rate=1.0, max_rate=None, decrease=0.5,
+                 increase=None, cooldown=1.0, *args, **kwargs):
+        super(AdaptiveRateLimiter, self).__init__(rate, *args, **kwargs)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.decrease = decrease
+        self.increase = increase or self.max_rate / 20.
+        self.cooldown = cooldown
+        self.__decreased = 0
+
+    def throttled(self, attempt=0):
+        with self._lock:
+            now = time.time()
+            if now - self.__decreased >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.__decreased = now
+        return super(AdaptiveRateLimiter, self).throttled(attempt)
+
+    def succeeded(self):
+        with self._lock:
+            # at the current rate, this many successes make up a second
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
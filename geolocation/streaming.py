@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2009 Örjan Persson
+
+import re
+
+from geolocation import codecs
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+_structure = re.compile(r'["\[\]{}]')
+_string_end = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+
+
+class _NeedMore(Exception):
+    """The buffer ends before the current value"""
+    pass
+
+
+class JsonStreamParser(object):
+    """Incremental parser for a JSON object holding a large array
+
+    Reads the object from an iterable of chunks, yielding the elements of
+    the array member named `key` one at a time as soon as each one is
+    complete. Other members are parsed whole. Only the element being parsed
+    is kept in memory, and no element (or other member) may be larger than
+    `max_size` bytes.
+
+    Yields tuples of ``('item', value)`` for array elements and
+    ``('member', name, value)`` for other members, in document order.
+    """
+
+    def __init__(self, chunks, key, max_size=1 << 20):
+        self.loads = codecs.get_json_engine().loads
+        self.chunks = iter(chunks)
+        self.key = key
+        self.max_size = max_size
+        self.buffer = ''
+        self.pos = 0
+
+    def __iter__(self):
+        self.expect('{')
+        if self.peek() == '}':
+            return
+
+        while True:
+            name = self.value()
+            self.expect(':')
+
+            if name == self.key and self.peek() == '[':
+                for item in self.array():
+                    yield ('item', item)
+            else:
+                yield ('member', name, self.value())
+
+            if self.expect(',}') == '}':
+                return
+
+    def array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+    def value(self):
+        """Parse the value at the current position"""
+        while True:
+            self.skip()
+            try:
+                end = self.value_end(self.pos)
+            except _NeedMore:
+                self.read()
+                continue
+
+            value = self.loads(self.buffer[self.pos:end])
+            self.pos = end
+            return value
+
+    def value_end(self, pos):
+        """Find where the value starting at `pos` ends"""
+        buffer = self.buffer
+        if pos >= len(buffer):
+            raise _NeedMore()
+
+        first = buffer[pos]
+        if first == '"':
+            match = _string_end.match(buffer, pos + 1)
+            if not match:
+                raise _NeedMore()
+            return match.end()
+
+        if first not in '[{':
+            # scalar, ends at the first structural character after it
+            end = pos
+            while end < len(buffer) and buffer[end] not in ',]} \t\n\r':
+                end += 1
+            if end == len(buffer):
+                raise _NeedMore()
+            return end
+
+        depth = 0
+        while True:
+            match = _structure.search(buffer, pos)
+            if not match:
+                raise _NeedMore()
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                match = _string_end.match(buffer, pos)
+                if not match:
+                    raise _NeedMore()
+                pos = match.end()
+            elif char in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos
+
+    def expect(self, chars):
+        """Consume one of `chars`, returning it"""
+        char = self.peek()
+        if char not in chars:
+            raise codecs.GeolocationDecodeError('Expected %s at %d, found %r' % \
+                                                (' or '.join(chars), self.pos, char))
+        self.pos += 1
+        return char
+
+    def peek(self):
+        self.skip()
+        while self.pos >= len(self.buffer):
+            self.read()
+            self.skip()
+        return self.buffer[self.pos]
+
+    def skip(self):
+        self.pos = _whitespace.match(self.buffer, self.pos).end()
+
+    def read(self):
+        # drop everything parsed so far before reading more
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        if len(self.buffer) > self.max_size:
+            raise codecs.GeolocationDecodeError('Value larger than %d bytes' % \
+                                                (self.max_size,))
+        try:
+            chunk = self.chunks.next()
+        except StopIteration:
+            raise codecs.GeolocationDecodeError('Unexpected end of data')
+        self.buffer += chunk